@@ -26,7 +26,7 @@ setup(
     packages=find_packages(),
     install_requires=[
         'Pint>=0.16.1',
-        'click>=7.1.2',
+        'click>=8.0',
         'paho-mqtt>=1.5.1',
         'prometheus-client>=0.8.0',
         'pyserial>=3.4',
@@ -34,5 +34,6 @@ setup(
     entry_points='''
 [console_scripts]
 vedirect=vedirect.cli:app
+vedirect-bench=vedirect.bench:main
     ''',
 )
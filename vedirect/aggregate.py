@@ -0,0 +1,218 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Keeps fleet and group totals of fields up to date as blocks arrive.
+
+Each block replaces the previous contribution of its device to the
+totals of every group it belongs to, so a total costs O(1) per block
+instead of a sum over every device at every query. Every device is in
+the FLEET group; other groups are listed in the config.
+"""
+
+import math
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Set
+
+from . import block
+from . import defs
+
+# The group of all devices.
+FLEET = 'fleet'
+
+# Fields totalled by default: PV power, yield today, and battery
+# current.
+LABELS = ('PPV', 'H20', 'I')
+
+# Seconds without a block before a device is dropped from the totals.
+STALE = 60.0
+
+# Totals are recomputed from scratch after this many updates so that
+# rounding errors do not build up.
+_REBUILD = 1000
+
+
+class Aggregator:
+    """Aggregator totals fields per group.
+
+    Use as an exporter. groups maps a group name to the serial numbers
+    in it. After each block, the totals of its groups are passed to
+    each of sinks as a block with a SER# of total_<group> and the
+    number of devices in N, such as to an mqtt.Exporter. Safe to read
+    from another thread.
+    """
+    def __init__(self,
+                 labels: Sequence[str] = LABELS,
+                 groups: Optional[Dict[str, Sequence[str]]] = None,
+                 stale: float = STALE,
+                 sinks: Sequence = ()):
+        self._labels = labels
+        self._config = {g: set(sers) for g, sers in (groups or {}).items()}
+        self._stale = stale
+        self._sinks = sinks
+        # Maps the serial number to the groups it is in.
+        self._groups = {}  # type: Dict[str, List[str]]
+        # Maps the serial number to its contribution to each label.
+        self._values = {}  # type: Dict[str, Dict[str, float]]
+        self._seen = {}  # type: Dict[str, float]
+        self._members = {}  # type: Dict[str, Set[str]]
+        self._totals = {}  # type: Dict[str, Dict[str, float]]
+        self._updates = 0
+        self._checked = 0.0
+        self._lock = threading.RLock()
+
+    def _groups_of(self, ser: str) -> List[str]:
+        groups = self._groups.get(ser)
+        if groups is None:
+            groups = self._groups[ser] = [FLEET] + sorted(
+                g for g, sers in self._config.items() if ser in sers)
+        return groups
+
+    def _remove(self, ser: str) -> None:
+        old = self._values.pop(ser)
+        del self._seen[ser]
+        for g in self._groups_of(ser):
+            self._members[g].discard(ser)
+            totals = self._totals[g]
+            for label, v in old.items():
+                totals[label] -= v
+
+    def _rebuild(self) -> None:
+        for g, members in self._members.items():
+            self._totals[g] = {
+                label: math.fsum(self._values[ser].get(label, 0)
+                                 for ser in members)
+                for label in self._labels
+            }
+
+    def expire(self, now: Optional[float] = None) -> List[str]:
+        """Drops devices not seen for stale seconds from the totals.
+
+        Returns the groups whose totals changed.
+        """
+        if now is None:
+            now = time.monotonic()
+        changed = set()  # type: Set[str]
+        with self._lock:
+            for ser, seen in list(self._seen.items()):
+                if now - seen >= self._stale:
+                    self._remove(ser)
+                    changed.update(self._groups_of(ser))
+        return sorted(changed)
+
+    def export(self, fields) -> None:
+        ser = fields.get(defs.SER.label)
+        if ser is None:
+            return
+        values = dict(block.plain(fields))
+        new = {
+            label: values[label]
+            for label in self._labels
+            if isinstance(values.get(label), (int, float))
+        }
+        with self._lock:
+            changed = self._update(ser, new)
+        if self._sinks:
+            t = block.arrival(fields)
+            for g in changed:
+                total = self.total(g, t)
+                for s in self._sinks:
+                    s.export(total)
+
+    def _update(self, ser: str, new: Dict[str, float]) -> List[str]:
+        """Replaces the contribution of a device and returns the groups
+        whose totals changed."""
+        now = time.monotonic()
+        old = self._values.get(ser, {})
+        self._values[ser] = new
+        self._seen[ser] = now
+
+        groups = self._groups_of(ser)
+        for g in groups:
+            self._members.setdefault(g, set()).add(ser)
+            totals = self._totals.setdefault(
+                g, {label: 0.0
+                    for label in self._labels})
+            for label in self._labels:
+                totals[label] += new.get(label, 0) - old.get(label, 0)
+
+        self._updates += 1
+        if self._updates % _REBUILD == 0:
+            self._rebuild()
+
+        changed = set(groups)
+        if now - self._checked >= 1:
+            self._checked = now
+            changed.update(self.expire(now))
+        return sorted(changed)
+
+    def groups(self) -> List[str]:
+        """Returns the groups that have had a device."""
+        with self._lock:
+            return sorted(self._totals)
+
+    def devices(self, group: str) -> int:
+        """Returns the number of live devices in a group."""
+        with self._lock:
+            return len(self._members.get(group, ()))
+
+    def total(self, group: str, t: float = 0.0) -> block.Block:
+        """Returns the totals of a group as a block at time t."""
+        with self._lock:
+            values = {
+                defs.SER.label: 'total_%s' % group,
+                'N': self.devices(group)
+            }  # type: Dict[str, object]
+            for label, v in self._totals.get(group, {}).items():
+                values[label] = round(v, 9)
+        return block.Block(values, t)
+
+
+class Collector:
+    """Exports the totals as victron_total_<field> gauges by group.
+
+    Register with prometheus_client.REGISTRY.register().
+    """
+    def __init__(self, aggregator: Aggregator):
+        self._aggregator = aggregator
+
+    def collect(self):
+        # pylint: disable=import-outside-toplevel,protected-access
+        from prometheus_client import core
+
+        from . import prometheus
+
+        a = self._aggregator
+        a.expire()
+        devices = core.GaugeMetricFamily(
+            'victron_total_devices',
+            'Number of devices reporting in the group',
+            labels=['group'])
+        families = {}
+        for g in a.groups():
+            devices.add_metric([g], a.devices(g))
+            for label, v in a.total(g).items():
+                if label in (defs.SER.label, 'N'):
+                    continue
+                family = families.get(label)
+                if family is None:
+                    f = defs.lookup(label)
+                    name, unit = prometheus._name_unit(f)
+                    family = families[label] = core.GaugeMetricFamily(
+                        name.replace('victron_', 'victron_total_', 1),
+                        'Total over the group of: ' + f.description,
+                        labels=['group'],
+                        unit=unit)
+                family.add_metric([g], round(v, 3))
+        yield devices
+        yield from families.values()
@@ -0,0 +1,299 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Reads many serial ports and network bridges on one asyncio event loop.
+
+Local ports are watched with loop.add_reader(). tcp://host:port URLs
+are read as raw TCP streams, such as from ser2net, and rfc2217:// URLs
+through pyserial on a thread of their own.
+
+Every source is supervised: when it fails or no block arrives for a
+while, it is closed and reopened with backoff and the parser resyncs,
+while the exporters carry on.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+from typing import Callable, Dict, List, Optional, Sequence
+
+import serial
+
+from . import capture
+from . import hexproto
+from . import instrument
+from . import source
+from . import text
+
+# Number of bytes to request from a network source per read.
+_READ_SIZE = 1000
+
+# Seconds an RFC 2217 read waits for data.
+_RFC2217_TIMEOUT = 0.5
+
+# Seconds without a block before a source is reopened.
+STALE_TIMEOUT = 30.0
+
+
+class _Reader:
+    """Decodes one source and passes each block to the exporters.
+
+    Subclasses implement _read(), which reads until the source fails.
+    """
+    def __init__(self, port: str, exporters: Sequence, validate: bool,
+                 compact: bool, capture_path: Optional[str],
+                 instruments: Optional[instrument.Instruments],
+                 stale: float = STALE_TIMEOUT,
+                 polls: Optional[Dict[int, float]] = None):
+        self._port = port
+        self._exporters = exporters
+        self._stale = stale
+        self._polls = polls
+        self._parser = text.Parser(validate, compact)
+        self._port_stats = instruments.port(
+            port, self._parser) if instruments else None
+        self._capture = capture.Writer(
+            capture_path) if capture_path else None
+        self._backoff = source.Backoff()
+        self._last_block = 0.0
+
+    def _export(self, blocks: List[text.Fields]) -> None:
+        if blocks:
+            self._last_block = asyncio.get_running_loop().time()
+            # Only a source that delivers blocks counts as healthy.
+            self._backoff.reset()
+        for fields in blocks:
+            for e in self._exporters:
+                e.export(fields)
+
+    def _decode(self, decode: Callable[..., List[text.Fields]],
+                *args) -> None:
+        """Exports the blocks returned by decode(*args).
+
+        A framing error is logged and the parser resumes at the next
+        block, as a garbled adapter reset must not stop the reader.
+        """
+        try:
+            blocks = decode(*args)
+        except text.ProtocolError as ex:
+            logging.warning('%s: %s; resyncing', self._port, ex)
+            blocks = ex.blocks
+        self._export(blocks)
+
+    def _feed(self, data: bytes) -> None:
+        if self._capture:
+            self._capture.write(data)
+        if self._port_stats:
+            self._decode(self._port_stats.feed, data)
+        else:
+            self._decode(self._parser.feed, data)
+
+    async def _read(self) -> None:
+        """Reads until the source fails."""
+        raise NotImplementedError
+
+    async def _watch(self) -> None:
+        """Raises TimeoutError when no block arrives in time."""
+        loop = asyncio.get_running_loop()
+        self._last_block = loop.time()
+        while True:
+            idle = loop.time() - self._last_block
+            if idle >= self._stale:
+                raise TimeoutError('no block in %.0f s' % idle)
+            await asyncio.sleep(self._stale - idle)
+
+    async def _supervise(self) -> None:
+        tasks = [asyncio.ensure_future(self._read())]
+        if self._stale:
+            tasks.append(asyncio.ensure_future(self._watch()))
+        try:
+            done, _ = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                t.result()
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self._supervise()
+            except (OSError, EOFError, serial.SerialException) as ex:
+                delay = self._backoff.next()
+                logging.warning('%s failed: %s; reopening in %.1f s',
+                                self._port, ex, delay)
+                if self._port_stats:
+                    self._port_stats.reconnects += 1
+                # The stream is discontinuous across connections.
+                self._parser.reset()
+                await asyncio.sleep(delay)
+
+
+class _SerialReader(_Reader):
+    """Reads a local port straight into the parser buffer when readable.
+
+    The path is opened afresh each time, so stable names such as
+    /dev/serial/by-id/... follow the adapter when it is replugged. If
+    registers are polled, reads go through a hexproto.Session instead.
+    """
+    def _fill(self, readinto) -> List[text.Fields]:
+        if self._port_stats:
+            return self._port_stats.fill(readinto)
+        return self._parser.fill(readinto)[1]
+
+    async def _read(self) -> None:
+        loop = asyncio.get_running_loop()
+        src = source.SerialSource(self._port)
+        logging.info('opened %s (%s)', self._port,
+                     os.path.realpath(self._port))
+        readinto = src.readinto
+        if self._capture:
+            readinto = capture.Tee(src, self._capture).readinto
+        session = None
+        if self._polls:
+            feed = self._port_stats.feed if self._port_stats else (
+                self._parser.feed)
+            session = hexproto.Session(feed, src.write, self._polls)
+            buf = bytearray(_READ_SIZE)
+        done = loop.create_future()
+
+        def on_readable():
+            try:
+                if session is None:
+                    self._decode(self._fill, readinto)
+                    return
+                with memoryview(buf) as view:
+                    got = readinto(view)
+                if got:
+                    self._decode(session.feed, bytes(buf[:got]))
+            except Exception as ex:  # pylint: disable=broad-except
+                if not done.done():
+                    done.set_exception(ex)
+
+        async def poll():
+            while True:
+                await asyncio.sleep(session.poll())
+
+        waits = [done]
+        if session:
+            waits.append(asyncio.ensure_future(poll()))
+        fd = src.fileno()
+        loop.add_reader(fd, on_readable)
+        try:
+            finished, _ = await asyncio.wait(
+                waits, return_when=asyncio.FIRST_COMPLETED)
+            for f in finished:
+                f.result()
+        finally:
+            for f in waits:
+                f.cancel()
+            loop.remove_reader(fd)
+            src.close()
+
+
+class _TCPReader(_Reader):
+    """Reads a raw TCP stream such as from ser2net."""
+    async def _read(self) -> None:
+        host, port = source.address(self._port)
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while True:
+                data = await reader.read(_READ_SIZE)
+                if not data:
+                    raise EOFError('connection closed')
+                self._feed(data)
+        finally:
+            writer.close()
+
+
+class _RFC2217Reader(_Reader):
+    """Reads an RFC 2217 port server through pyserial.
+
+    pyserial's client blocks, so each port is read on its own thread.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    async def _read(self) -> None:
+        loop = asyncio.get_running_loop()
+        s = await loop.run_in_executor(
+            self._executor, lambda: serial.serial_for_url(
+                self._port, 19200, timeout=_RFC2217_TIMEOUT))
+        try:
+            while True:
+                data = await loop.run_in_executor(self._executor, s.read,
+                                                  _READ_SIZE)
+                if data:
+                    self._feed(data)
+        finally:
+            s.close()
+
+
+def _reader(port: str, *args) -> _Reader:
+    """Returns the reader for a port path or URL."""
+    if source.is_url(port):
+        if port.startswith(source.TCP + ':'):
+            return _TCPReader(port, *args)
+        return _RFC2217Reader(port, *args)
+    return _SerialReader(port, *args)
+
+
+def capture_path(base: Optional[str], ports: Sequence[str],
+                 port: str) -> Optional[str]:
+    """Returns the capture file for one of ports.
+
+    That is base for a single port, or else base.<port name>.
+    """
+    if not base or len(ports) == 1:
+        return base
+    return '%s.%s' % (base, os.path.basename(port))
+
+
+async def _run(ports: Sequence[str], exporters: Sequence, validate: bool,
+               compact: bool, capture_base: Optional[str],
+               instruments: Optional[instrument.Instruments], stale: float,
+               polls: Optional[Dict[int, float]]) -> None:
+    readers = [
+        _reader(p, exporters, validate, compact,
+                capture_path(capture_base, ports, p), instruments, stale,
+                polls)
+        for p in ports
+    ]  # type: List[_Reader]
+    await asyncio.gather(*(r.run() for r in readers))
+
+
+def run(ports: Sequence[str],
+        exporters: Sequence,
+        validate: bool = False,
+        compact: bool = False,
+        capture_path: Optional[str] = None,
+        instruments: Optional[instrument.Instruments] = None,
+        stale: float = STALE_TIMEOUT,
+        polls: Optional[Dict[int, float]] = None) -> None:
+    """Reads all ports and passes every block to each exporter.
+
+    Ports are local paths or tcp://host:port and rfc2217://host:port
+    URLs. A port that fails or gives no block for stale seconds is
+    reopened; a stale of 0 only reopens failed ports. If capture_path
+    is set, everything read is recorded to it, or with many ports to
+    capture_path.<port name>. Reads and decoding are measured in
+    instruments if set. polls maps register ids to the seconds between
+    polls of them over the HEX protocol on local ports. Runs forever.
+    """
+    asyncio.run(
+        _run(ports, exporters, validate, compact, capture_path,
+             instruments, stale, polls))
@@ -0,0 +1,271 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Archives decoded blocks to compact columnar files.
+
+An archive file starts with MAGIC and is followed by chunks. Each
+chunk holds up to a few hundred blocks of one device that have the
+same numeric fields, and is written as:
+
+- a little endian header of the JSON info length, the body length,
+  and the float64 times of the first and last block,
+- the JSON info: serial number, block count, labels, the scale of
+  each label, the byte size of each column, and the latest value of
+  each string field,
+- the body: the times in milliseconds followed by one column per
+  label, each as zigzag varints of the difference from the previous
+  value.
+
+Values are stored as integers in the fixed scale of their label from
+defs, so a voltage in mV is stored exactly. Float values of fields in
+whole units, like the derived PB, are stored in thousandths. Chunks
+outside a time range, and columns that are not asked for, are skipped
+when loading.
+"""
+
+import array
+import glob
+import json
+import os
+import struct
+import time
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+
+from . import block
+from . import defs
+
+MAGIC = b'VEDARC1\n'
+
+_HEADER = struct.Struct('<IIdd')
+
+# Default number of blocks per chunk.
+CHUNK = 600
+
+
+def _encode(values: Iterable[int], out: bytearray) -> None:
+    """Appends values as zigzag varints of their deltas."""
+    prev = 0
+    for v in values:
+        d = v - prev
+        prev = v
+        z = d * 2 if d >= 0 else -d * 2 - 1
+        while z >= 0x80:
+            out.append(z & 0x7F | 0x80)
+            z >>= 7
+        out.append(z)
+
+
+def _decode(data: bytes, count: int) -> array.array:
+    """Decodes count zigzag varint deltas."""
+    out = array.array('q', bytes(8 * count))
+    pos = 0
+    prev = 0
+    for i in range(count):
+        z = 0
+        shift = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            z |= (b & 0x7F) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        prev += (z >> 1) ^ -(z & 1)
+        out[i] = prev
+    return out
+
+
+# The scale of float values of fields in whole units. The TEXT protocol
+# sends these as ints, while derived fields and values merged from HEX
+# registers have fractions.
+_FINE = 0.001
+
+
+def _scale(label: str, value: object) -> float:
+    scale = defs.SCALES.get(label)
+    factor = scale.factor if scale else 1
+    return _FINE if factor == 1 and isinstance(value, float) else factor
+
+
+class _Chunk:
+    """_Chunk collects the blocks of one device until written."""
+    def __init__(self, ser: str, labels: Tuple[str, ...],
+                 scales: Tuple[float, ...]):
+        self.ser = ser
+        self.labels = labels
+        self.scales = scales
+        self.times = array.array('q')
+        self.cols = [array.array('q') for _ in labels]
+        self.strings = {}  # type: Dict[str, str]
+        self.first = 0.0
+        self.last = 0.0
+
+    def add(self, t: float, values: dict) -> None:
+        if not self.times:
+            self.first = t
+        self.last = t
+        self.times.append(round(t * 1000))
+        for label, scale, col in zip(self.labels, self.scales, self.cols):
+            col.append(round(values[label] / scale))
+
+    def encode(self) -> bytes:
+        body = bytearray()
+        sizes = []
+        for col in [self.times] + self.cols:
+            start = len(body)
+            _encode(col, body)
+            sizes.append(len(body) - start)
+        info = json.dumps({
+            'ser': self.ser,
+            'count': len(self.times),
+            'labels': self.labels,
+            'scales': self.scales,
+            'sizes': sizes,
+            'strings': self.strings,
+        }).encode()
+        return _HEADER.pack(len(info), len(body), self.first,
+                            self.last) + info + bytes(body)
+
+
+class Exporter:
+    """Exporter archives every block to files in a directory.
+
+    A chunk is written for a device once it has chunk blocks or its
+    numeric fields change, so the card is written to rarely. A new
+    file named by its UTC start time is started once the current one
+    reaches rotate_bytes or is rotate_seconds old. Call close() to
+    write the pending chunks.
+    """
+    def __init__(self,
+                 directory: str,
+                 chunk: int = CHUNK,
+                 rotate_bytes: int = 16 << 20,
+                 rotate_seconds: float = 86400):
+        os.makedirs(directory, exist_ok=True)
+        self._dir = directory
+        self._chunk = chunk
+        self._rotate_bytes = rotate_bytes
+        self._rotate_seconds = rotate_seconds
+        self._chunks = {}  # type: Dict[str, _Chunk]
+        self._f = None
+        self._opened = 0.0
+
+    def _write(self, c: _Chunk) -> None:
+        if (self._f is None or self._f.tell() >= self._rotate_bytes
+                or c.first - self._opened >= self._rotate_seconds):
+            if self._f:
+                self._f.close()
+            name = 'vedirect-%s.vda' % time.strftime('%Y%m%dT%H%M%S',
+                                                     time.gmtime(c.first))
+            self._f = open(os.path.join(self._dir, name), 'ab')
+            if self._f.tell() == 0:
+                self._f.write(MAGIC)
+            self._opened = c.first
+        self._f.write(c.encode())
+        self._f.flush()
+
+    def export(self, fields) -> None:
+        ser = fields.get('SER#')
+        if ser is None:
+            return
+        now = block.arrival(fields)
+        values = dict(block.plain(fields))
+        labels = tuple(x for x, v in values.items() if not isinstance(v, str))
+        scales = tuple(_scale(x, values[x]) for x in labels)
+
+        c = self._chunks.get(ser)
+        if c is not None and (c.labels != labels or c.scales != scales):
+            self._write(c)
+            c = None
+        if c is None:
+            c = self._chunks[ser] = _Chunk(ser, labels, scales)
+        c.add(now, values)
+        c.strings.update(
+            (x, v) for x, v in values.items() if isinstance(v, str))
+        if len(c.times) >= self._chunk:
+            self._write(c)
+            del self._chunks[ser]
+
+    def close(self) -> None:
+        for c in self._chunks.values():
+            self._write(c)
+        self._chunks = {}
+        if self._f:
+            self._f.close()
+            self._f = None
+
+
+def _chunks(path: str, since: float,
+            until: float) -> Iterator[Tuple[dict, bytes]]:
+    """Yields the info and body of each chunk that overlaps the range.
+
+    A chunk torn by a power loss while writing ends the file.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not an archive' % path)
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            info_size, body_size, first, last = _HEADER.unpack(header)
+            if last < since or first >= until:
+                f.seek(info_size + body_size, os.SEEK_CUR)
+                continue
+            info = f.read(info_size)
+            body = f.read(body_size)
+            if len(info) < info_size or len(body) < body_size:
+                return
+            yield json.loads(info), body
+
+
+def files(directory: str) -> List[str]:
+    """Returns the archive files in a directory, oldest first."""
+    return sorted(glob.glob(os.path.join(directory, 'vedirect-*.vda')))
+
+
+def load(paths: Iterable[str],
+         ser: str,
+         labels: Sequence[str],
+         since: float = 0,
+         until: float = float('inf')
+         ) -> Tuple[array.array, Dict[str, array.array]]:
+    """Loads fields of one device in [since, until) from archive files.
+
+    Returns the block times in seconds and the values of each label,
+    all as array('d'). Values are NaN for blocks without the field.
+    """
+    times = array.array('d')
+    out = {x: array.array('d') for x in labels}
+    for path in paths:
+        for info, body in _chunks(path, since, until):
+            if info['ser'] != ser:
+                continue
+            count = info['count']
+            offsets = [0]
+            for size in info['sizes']:
+                offsets.append(offsets[-1] + size)
+            ms = _decode(body[:offsets[1]], count)
+            keep = [
+                i for i in range(count) if since <= ms[i] / 1000 < until
+            ]
+            times.extend(ms[i] / 1000 for i in keep)
+            for label in labels:
+                if label not in info['labels']:
+                    out[label].extend([float('nan')] * len(keep))
+                    continue
+                j = info['labels'].index(label)
+                col = _decode(body[offsets[j + 1]:offsets[j + 2]], count)
+                scale = info['scales'][j]
+                out[label].extend(col[i] * scale for i in keep)
+    return times, out
@@ -0,0 +1,314 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks the parser and exporters against a synthetic stream.
+
+Run with `python -m vedirect.bench`.
+"""
+
+import json
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Sequence
+
+import click
+import prometheus_client
+
+from . import defs
+from . import mqtt
+from . import prometheus
+from . import text
+from . import units
+
+# The fields sent by each kind of device, in the order they are sent.
+PROFILES = {
+    'mppt': (defs.PID, defs.FW, defs.SER, defs.V, defs.I, defs.VPV,
+             defs.PPV, defs.CS, defs.MPPT, defs.ERR, defs.LOAD, defs.IL,
+             defs.H19, defs.H20, defs.H21, defs.H22, defs.H23, defs.HSDS),
+    'bmv': (defs.PID, defs.SER, defs.V, defs.VS, defs.I, defs.P, defs.CE,
+            defs.SOC, defs.TTG, defs.Alarm, defs.Relay, defs.AR, defs.BMV,
+            defs.FW, defs.H1, defs.H2, defs.H3, defs.H4, defs.H5, defs.H6,
+            defs.H7, defs.H8, defs.H9, defs.H10, defs.H11, defs.H12,
+            defs.H15, defs.H16, defs.H17, defs.H18),
+    'inverter': (defs.PID, defs.FW, defs.SER, defs.MODE, defs.CS,
+                 defs.AC_OUT_V, defs.AC_OUT_I, defs.AC_OUT_S, defs.V,
+                 defs.AR, defs.WARN, defs.OR),
+}
+
+_PIDS = {'mppt': '0xA042', 'bmv': '0x203', 'inverter': '0xA231'}
+
+# Startup steps measured by bench_startup().
+_STARTUP = {
+    'import_text': 'import vedirect.text',
+    'import_cli': 'import vedirect.cli',
+    'import_prometheus': 'import vedirect.prometheus',
+    'import_mqtt': 'import vedirect.mqtt',
+    'pint_registry': 'import vedirect.units; vedirect.units.registry()',
+}
+
+
+def _value(profile: str, f: defs.Field, device: int,
+           rng: random.Random) -> str:
+    if f == defs.PID:
+        return _PIDS[profile]
+    if f == defs.SER:
+        return 'HQ%04dBENCH' % device
+    if f == defs.BMV:
+        return '700'
+    if f in (defs.LOAD, defs.Alarm, defs.Relay):
+        return rng.choice(('ON', 'OFF'))
+    if f.label in defs.ENUMS:
+        return str(rng.choice([x.value for x in defs.ENUMS[f.label]]))
+    if f == defs.OR:
+        return '0x%08X' % rng.randrange(16)
+    return str(rng.randrange(-500 if f.unit == 'mA' else 0, 30000))
+
+
+def _block(profile: str, device: int, rng: random.Random) -> bytes:
+    out = bytearray()
+    for f in PROFILES[profile]:
+        out += b'\r\n%s\t%s' % (f.label.encode(),
+                                _value(profile, f, device, rng).encode())
+    out += b'\r\nChecksum\t'
+    out.append(-sum(out) & 0xFF)
+    return bytes(out)
+
+
+def generate(profile: str,
+             blocks: int,
+             devices: int = 1,
+             corruption: float = 0.0,
+             seed: int = 0) -> List[bytes]:
+    """Generates a VE.Direct TEXT stream for each device.
+
+    Each stream starts with a partial block so that the parser has to
+    sync, and each block is corrupted by a random byte change with the
+    given probability.
+    """
+    rng = random.Random(seed)
+    streams = []
+    for device in range(devices):
+        out = bytearray(b'\r\nChecksum\tX')
+        for _ in range(blocks):
+            data = bytearray(_block(profile, device, rng))
+            if rng.random() < corruption:
+                data[rng.randrange(len(data))] ^= 1 << rng.randrange(8)
+            out += data
+        out += b'\r\n'
+        streams.append(bytes(out))
+    return streams
+
+
+def _percentiles(samples: Sequence[float]) -> Dict[str, float]:
+    cuts = statistics.quantiles(samples, n=100)
+    return {
+        'p50_us': cuts[49] * 1e6,
+        'p90_us': cuts[89] * 1e6,
+        'p99_us': cuts[98] * 1e6,
+    }
+
+
+def bench_parse(stream: bytes, validate: bool,
+                compact: bool) -> Dict[str, float]:
+    """Measures the parse throughput of a stream fed in 1000 byte reads."""
+    if not compact:
+        # The registry is built lazily on first use and is measured by
+        # bench_startup() instead.
+        units.registry()
+    parser = text.Parser(validate, compact)
+    blocks = 0
+    start = time.perf_counter()
+    for i in range(0, len(stream), 1000):
+        blocks += len(parser.feed(stream[i:i + 1000]))
+    elapsed = time.perf_counter() - start
+    return {
+        'blocks_per_s': blocks / elapsed,
+        'mib_per_s': len(stream) / elapsed / 2**20,
+    }
+
+
+def bench_export(export: Callable[[object], None],
+                 blocks: Sequence) -> Dict[str, float]:
+    """Measures the latency and memory use of each export() call."""
+    times = []
+    for fields in blocks:
+        start = time.perf_counter()
+        export(fields)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    peaks = []
+    for fields in blocks[:200]:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        export(fields)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+
+    result = _percentiles(times)
+    result['peak_bytes_per_block'] = statistics.mean(peaks)
+    return result
+
+
+def bench_startup(repeat: int = 3) -> Dict[str, float]:
+    """Measures each startup step in a fresh interpreter.
+
+    Use `python -X importtime` to break a step down by module.
+    """
+    result = {}
+    for name, stmt in _STARTUP.items():
+        code = ('import time; start = time.perf_counter(); %s; '
+                'print(time.perf_counter() - start)' % stmt)
+        result[name + '_s'] = min(
+            float(subprocess.check_output([sys.executable, '-c', code]))
+            for _ in range(repeat))
+    return result
+
+
+class _NullClient:
+    """An MQTT client that drops everything."""
+    def publish(self, *args, **kwargs):
+        pass
+
+
+def _exporters() -> Dict[str, Callable[[], Callable[[object], None]]]:
+    def prometheus_exporter():
+        registry = prometheus_client.CollectorRegistry()
+        return prometheus.Exporter(registry).export
+
+    def prometheus_collector():
+        return prometheus.Collector().export
+
+    def mqtt_exporter():
+        return mqtt.Exporter('localhost', client=_NullClient()).export
+
+    return {
+        'prometheus': prometheus_exporter,
+        'prometheus_collector': prometheus_collector,
+        'mqtt': mqtt_exporter,
+    }
+
+
+def run(profile: str, blocks: int, devices: int,
+        corruption: float) -> Dict[str, Dict[str, float]]:
+    """Runs all benchmarks and returns the results by name."""
+    results = {}
+    clean = generate(profile, blocks)[0]
+    streams = generate(profile, blocks, devices, corruption)
+
+    for validate in (False, True):
+        for compact in (False, True):
+            name = 'parse%s%s' % ('_validate' if validate else '',
+                                  '_compact' if compact else '')
+            # Only a validating parser survives corruption.
+            stream = streams[0] if validate else clean
+            results[name] = bench_parse(stream, validate, compact)
+
+    # Interleave the devices as they would arrive at a gateway.
+    parsed = [
+        text.Parser(validate=True, compact=True).feed(s) for s in streams
+    ]
+    interleaved = [x for group in zip(*parsed) for x in group]
+
+    for name, make in _exporters().items():
+        results['export_' + name] = bench_export(make(), interleaved)
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    keep = [make() for make in _exporters().values()]
+    for export in keep:
+        for fields in interleaved:
+            export(fields)
+    results['memory'] = {
+        'bytes_per_device':
+        (tracemalloc.get_traced_memory()[0] - base) / devices,
+    }
+    tracemalloc.stop()
+
+    results['startup'] = bench_startup()
+    return results
+
+
+def _compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """Returns a description of each result worse than the baseline."""
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+            if not old:
+                continue
+            # Throughputs regress when they drop, everything else
+            # when it rises.
+            ratio = old / value if metric.endswith('_per_s') else value / old
+            if ratio > 1 + threshold:
+                regressions.append('%s.%s: %.4g -> %.4g (%+.0f%%)' %
+                                   (name, metric, old, value,
+                                    (ratio - 1) * 100))
+    return regressions
+
+
+@click.command()
+@click.option('--profile',
+              type=click.Choice(sorted(PROFILES)),
+              default='mppt',
+              help='Device type to generate blocks for')
+@click.option('--blocks',
+              type=click.IntRange(min=100),
+              default=2000,
+              help='Number of blocks per device')
+@click.option('--devices',
+              type=click.IntRange(min=1),
+              default=4,
+              help='Number of devices')
+@click.option('--corruption',
+              type=click.FloatRange(0, 1),
+              default=0.0,
+              help='Probability that a block is corrupted')
+@click.option('--baseline',
+              type=click.Path(dir_okay=False),
+              help='JSON file of earlier results to compare against')
+@click.option('--save',
+              is_flag=True,
+              help='If supplied, write the results to --baseline')
+@click.option('--threshold',
+              type=float,
+              default=0.1,
+              help='Fraction worse than the baseline that is a regression')
+def main(profile: str, blocks: int, devices: int, corruption: float,
+         baseline: str, save: bool, threshold: float):
+    results = run(profile, blocks, devices, corruption)
+    for name, metrics in results.items():
+        print('%-28s %s' % (name, ' '.join('%s=%.4g' % x
+                                           for x in metrics.items())))
+
+    if not baseline:
+        return
+    if save:
+        with open(baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        return
+
+    with open(baseline) as f:
+        regressions = _compare(results, json.load(f), threshold)
+    for r in regressions:
+        print('REGRESSION', r)
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,108 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A compact, pint free representation of a block."""
+
+import collections.abc
+import time as _time
+from typing import Iterable, Iterator, Tuple
+
+from . import defs
+from . import units
+
+
+class Block(collections.abc.Mapping):
+    """Block holds the fields of one block as plain values.
+
+    Quantities are stored as numbers already multiplied by the scale
+    in defs.SCALES, enums as ints, and everything else as str. Use
+    value() or to_dict() to get the same types as text.parse().
+
+    time is when the first byte of the block arrived, in seconds since
+    the epoch.
+    """
+    __slots__ = ('_values', 'time')
+
+    def __init__(self, values: dict, time: float = 0.0):
+        self._values = values
+        self.time = time
+
+    def __getitem__(self, label: str) -> object:
+        return self._values[label]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._values)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __repr__(self) -> str:
+        return 'Block(%r)' % self._values
+
+    def items(self):
+        return self._values.items()
+
+    def unit(self, label: str) -> str:
+        """Returns the unit of a quantity, or '' for other fields."""
+        if label in defs.SCALES:
+            return defs.SCALES[label].unit
+        return ''
+
+    def value(self, label: str) -> object:
+        """Returns the field as a pint quantity, enum, or str."""
+        value = self._values[label]
+        if label in defs.SCALES and not isinstance(value, str):
+            return value * units.unit(defs.SCALES[label].unit)
+        if label in defs.ENUMS and not isinstance(value, str):
+            try:
+                return defs.ENUMS[label](value)
+            except ValueError:
+                return value
+        return value
+
+    def to_dict(self) -> dict:
+        """Converts to the same form as yielded by text.parse()."""
+        return {label: self.value(label) for label in self._values}
+
+
+class Quantities(dict):
+    """Quantities holds the fields of one block as returned by
+    text.parse(): pint quantities, enums, and str.
+
+    time is when the first byte of the block arrived, as for Block.
+    """
+    __slots__ = ('time', )
+
+    def __init__(self, values=(), time: float = 0.0):
+        super().__init__(values)
+        self.time = time
+
+    def copy(self) -> 'Quantities':
+        return Quantities(self, self.time)
+
+
+def arrival(fields) -> float:
+    """Returns when the first byte of a block arrived, or now if that
+    is not known."""
+    return getattr(fields, 'time', 0.0) or _time.time()
+
+
+def plain(fields) -> Iterable[Tuple[str, object]]:
+    """Yields the label and plain value of each field.
+
+    fields may be a Block or a dict from text.parse(). Quantities are
+    converted to their magnitude.
+    """
+    if isinstance(fields, Block):
+        return fields.items()
+    return ((label, units.magnitude(value)) for label, value in fields.items())
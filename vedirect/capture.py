@@ -0,0 +1,137 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Records raw serial data with timestamps and replays it.
+
+A capture file starts with MAGIC and is followed by records of a
+little endian float64 arrival time in seconds since the epoch, a
+uint16 length, and that many bytes of data. Files are only ever
+appended to.
+"""
+
+import mmap
+import os
+import struct
+import time
+from typing import Optional, Tuple
+
+MAGIC = b'VEDCAP1\n'
+
+_HEADER = struct.Struct('<dH')
+
+
+class Writer:
+    """Writer appends timestamped reads to a capture file."""
+    def __init__(self, path: str):
+        self._f = open(path, 'ab')
+        if self._f.tell() == 0:
+            self._f.write(MAGIC)
+
+    def write(self, data: bytes, when: Optional[float] = None) -> None:
+        if when is None:
+            when = time.time()
+        for i in range(0, len(data), 0xFFFF):
+            chunk = data[i:i + 0xFFFF]
+            self._f.write(_HEADER.pack(when, len(chunk)))
+            self._f.write(chunk)
+        self._f.flush()
+
+    def close(self) -> None:
+        self._f.close()
+
+
+class Tee:
+    """Tee reads from a source and records everything read to a Writer.
+
+    Other attributes are passed through to the source.
+    """
+    def __init__(self, src, writer: Writer):
+        self._src = src
+        self._writer = writer
+
+    def read(self, size: int) -> bytes:
+        data = self._src.read(size)
+        if data:
+            self._writer.write(data)
+        return data
+
+    def readinto(self, view: memoryview) -> int:
+        got = self._src.readinto(view)
+        if got:
+            self._writer.write(view[:got])
+        return got
+
+    def __getattr__(self, name: str):
+        return getattr(self._src, name)
+
+
+class Replay:
+    """Replay is a source that reads back a capture file.
+
+    speed scales the original timing, so 2 replays twice as fast. A
+    speed of zero replays as fast as possible. read() and record()
+    raise EOFError at the end of the file.
+    """
+    def __init__(self, path: str, speed: float = 1.0):
+        self._speed = speed
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < len(MAGIC):
+                raise ValueError('%s is not a capture file' % path)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a capture file' % path)
+        self._pos = len(MAGIC)
+        self._pending = b''
+        # Arrival time of the last record read.
+        self._when = 0.0
+        # Capture time and wall time of the first record.
+        self._start = None  # type: Optional[Tuple[float, float]]
+
+    def _next(self) -> bytes:
+        if self._pos + _HEADER.size > len(self._map):
+            raise EOFError()
+        when, size = _HEADER.unpack_from(self._map, self._pos)
+        self._pos += _HEADER.size
+        data = self._map[self._pos:self._pos + size]
+        self._pos += size
+        self._when = when
+
+        if self._speed:
+            now = time.monotonic()
+            if self._start is None:
+                self._start = (when, now)
+            delay = (when - self._start[0]) / self._speed - (now -
+                                                             self._start[1])
+            if delay > 0:
+                time.sleep(delay)
+        return data
+
+    def read(self, size: int) -> bytes:
+        if not self._pending:
+            self._pending = self._next()
+        if len(self._pending) <= size:
+            data, self._pending = self._pending, b''
+        else:
+            data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def record(self) -> Tuple[bytes, float]:
+        """Returns the rest of the next record and when it arrived."""
+        if not self._pending:
+            self._pending = self._next()
+        data, self._pending = self._pending, b''
+        return data, self._when
+
+    def close(self) -> None:
+        self._map.close()
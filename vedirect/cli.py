@@ -12,47 +12,362 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import json
+import logging
+import os
+import signal
+import time
+from typing import Dict, Optional, Tuple
+
 import click
-import prometheus_client
-import serial
 
-from . import mqtt
-from . import prometheus
+from . import aio
+from . import capture
+from . import filters
+from . import hexproto
+from . import instrument
+from . import pipeline
+from . import shard
+from . import source
 from . import text
 
+# The exporters and their client libraries are imported in app() only
+# when enabled, as they dominate startup time.
+# pylint: disable=import-outside-toplevel
+
 
 class Echo:
+    """Echo prints each block, and a summary of the instruments every
+    minute if given."""
+    def __init__(self, instruments: Optional[instrument.Instruments] = None):
+        self._instruments = instruments
+        self._last = time.monotonic()
+
     def export(self, fields):
         print(fields)
+        if self._instruments and time.monotonic() - self._last >= 60:
+            self._last = time.monotonic()
+            print(self._instruments.summary())
+
+
+def _terminate(*_) -> None:
+    """Exits on SIGTERM, as sent by systemd, so that the atexit handlers
+    write the pending archive chunks and derived state."""
+    raise SystemExit(0)
+
+
+def _load_config(path: str) -> dict:
+    """Loads the JSON config file, or returns an empty config."""
+    if not path:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _parse_filters(specs: Tuple[str, ...]) -> Dict[str, str]:
+    """Parses LABEL=KIND filter specs."""
+    kinds = {}
+    for spec in specs:
+        label, _, kind = spec.partition('=')
+        if kind not in filters.KINDS:
+            raise click.BadParameter('want LABEL=KIND, got %r' % spec,
+                                     param_hint='--filter')
+        kinds[label] = kind
+    return kinds
+
+
+def _parse_policies(cfg: dict) -> dict:
+    """Parses the MQTT publish policies from the config into a dict of
+    label to mqtt.Policy."""
+    from . import mqtt
+    return {
+        label: mqtt.Policy(x.get('deadband', 0), x.get('min_interval', 0))
+        for label, x in cfg.get('mqtt_policies', {}).items()
+    }
+
+
+def _replay(src: capture.Replay, exporters: list, validate: bool,
+            compact: bool, instruments: Optional[instrument.Instruments],
+            name: str) -> None:
+    """Passes the blocks in a capture to the exporters until EOFError.
+
+    Blocks get the arrival time saved in the capture. Framing errors
+    are logged and the parser resyncs, as when reading a port.
+    """
+    parser = text.Parser(validate, compact)
+    feed = instruments.port(name, parser).feed if instruments else parser.feed
+
+    while True:
+        data, when = src.record()
+        try:
+            blocks = feed(data, when)
+        except text.ProtocolError as ex:
+            logging.warning('%s: %s; resyncing', name, ex)
+            blocks = ex.blocks
+        for fields in blocks:
+            for e in exporters:
+                e.export(fields)
 
 
 @click.command()
 @click.option('--port',
+              multiple=True,
+              help='Serial port connected to the controller, or a '
+              'tcp://host:port or rfc2217://host:port URL of a serial '
+              'bridge. May be repeated')
+@click.option('--capture',
+              'capture_path',
+              type=click.Path(dir_okay=False),
+              help='If supplied, append everything read to this capture '
+              'file. With many ports, the port name is appended')
+@click.option('--replay',
+              type=click.Path(exists=True, dir_okay=False),
+              help='If supplied, read from this capture file instead of a '
+              'port')
+@click.option('--replay_speed',
+              type=float,
+              default=1.0,
+              help='Replay speed relative to the capture, or 0 for as fast '
+              'as possible')
+@click.option('--stale_timeout',
+              type=click.FloatRange(min=0),
+              default=aio.STALE_TIMEOUT,
+              help='Reopen a port that gives no block for this many '
+              'seconds, or 0 to only reopen failed ports')
+@click.option('--poll',
+              'poll_specs',
+              multiple=True,
+              help='Poll a register over the HEX protocol as REGISTER='
+              'SECONDS, where REGISTER is a field such as V or a register '
+              'id in hex. Values are merged into the next block, so '
+              'polling faster than once a second gives no extra samples. '
+              'Local ports only. May be repeated')
+@click.option('--workers',
+              type=click.IntRange(min=1),
+              default=1,
+              help='Number of processes to spread the ports over. Workers '
+              'decode to compact blocks and are not instrumented')
+@click.option('--config',
               type=click.Path(exists=True),
-              required=True,
-              help='Serial port connected to the controller')
+              help='JSON config file. Serial ports are read from "ports"')
 @click.option('--prometheus_port',
               type=int,
               help='If supplied, export metrics on this port')
+@click.option('--prometheus_collector',
+              is_flag=True,
+              help='If supplied, build Prometheus metrics when scraped '
+              'instead of on every block')
+@click.option('--filter_tau',
+              type=click.FloatRange(min=0, min_open=True),
+              default=20.0,
+              help='Time constant in seconds of the Prometheus gauge filter')
+@click.option('--filter',
+              'filter_kinds',
+              multiple=True,
+              help='Filter for one field as LABEL=KIND, where KIND is one of '
+              + ', '.join(filters.KINDS) + '. May be repeated')
+@click.option('--history_port',
+              type=int,
+              help='If supplied, keep a history of every field in memory '
+              'and serve queries of it on this port')
+@click.option('--history_samples',
+              type=click.IntRange(min=1),
+              help='Number of raw samples kept per field, by default 10 '
+              'minutes at 1 Hz. Rollups are kept for 4 hours by minute, a '
+              'day by 15 minutes, and a week by hour')
+@click.option('--archive',
+              'archive_dir',
+              type=click.Path(file_okay=False),
+              help='If supplied, archive every block to compact files in '
+              'this directory')
+@click.option('--archive_rotate_mb',
+              type=click.FloatRange(min=0.01),
+              default=16,
+              help='Start a new archive file once the current one is this '
+              'many MiB')
+@click.option('--archive_rotate_hours',
+              type=click.FloatRange(min=0.01),
+              default=24,
+              help='Start a new archive file once the current one is this '
+              'many hours old')
 @click.option('--mqtt_host',
               help='If supplied, export metrics to this MQTT host')
+@click.option('--mqtt_json',
+              is_flag=True,
+              help='If supplied, publish each block as one JSON message')
+@click.option('--mqtt_qos',
+              type=click.IntRange(0, 2),
+              default=0,
+              help='QoS of the published fields')
+@click.option('--mqtt_retain',
+              is_flag=True,
+              help='If supplied, retain the published fields')
+@click.option('--mqtt_heartbeat',
+              type=float,
+              default=300,
+              help='Republish unchanged fields after this many seconds')
+@click.option('--mqtt_discovery_cache',
+              type=click.Path(dir_okay=False),
+              help='If supplied, remember published discovery records in '
+              'this file to avoid republishing them on restart')
+@click.option('--aggregate',
+              'aggregated',
+              is_flag=True,
+              help='If supplied, export totals of PPV, H20, and I over all '
+              'devices and the "groups" in the config')
+@click.option('--derive',
+              'derived',
+              is_flag=True,
+              help='If supplied, add the fields in defs.DERIVED, such as '
+              'battery power and integrated energy, to each block')
+@click.option('--derive_state',
+              type=click.Path(dir_okay=False),
+              help='If supplied, keep the integrated energies in this file '
+              'across restarts')
 @click.option('--echo',
               is_flag=True,
               help='If supplied, echo metrics to stdout')
-def app(port: str, prometheus_port: int, mqtt_host: str, echo: bool):
-    s = serial.Serial(port, 19200, timeout=0.7)
+@click.option('--instrument/--no-instrument',
+              'instrumented',
+              default=True,
+              help='Measure reads, decoding, and exporters and export the '
+              'results over Prometheus and --echo')
+@click.option('--validate',
+              is_flag=True,
+              help='If supplied, drop blocks with a bad checksum or framing')
+@click.option('--compact',
+              is_flag=True,
+              help='If supplied, decode to plain values instead of pint')
+@click.option('--queue_size',
+              type=click.IntRange(min=0),
+              default=0,
+              help='If non-zero, export from worker threads through a queue '
+              'of this many blocks')
+@click.option('--queue_policy',
+              type=click.Choice(pipeline.POLICIES),
+              default=pipeline.DROP_OLDEST,
+              help='What to do when the export queue is full')
+@click.option('--export_workers',
+              type=click.IntRange(min=1),
+              default=1,
+              help='Number of threads draining the export queue')
+def app(port: Tuple[str, ...], capture_path: str, replay: str,
+        replay_speed: float, stale_timeout: float,
+        poll_specs: Tuple[str, ...], workers: int, config: str,
+        prometheus_port: int, prometheus_collector: bool, filter_tau: float,
+        filter_kinds: Tuple[str, ...], history_port: int,
+        history_samples: int, archive_dir: str, archive_rotate_mb: float,
+        archive_rotate_hours: float, mqtt_host: str, mqtt_json: bool,
+        mqtt_qos: int, mqtt_retain: bool, mqtt_heartbeat: float,
+        mqtt_discovery_cache: str, aggregated: bool, derived: bool,
+        derive_state: str, echo: bool, instrumented: bool, validate: bool,
+        compact: bool, queue_size: int, queue_policy: str,
+        export_workers: int):
+    signal.signal(signal.SIGTERM, _terminate)
+    cfg = _load_config(config)
+    ports = list(port) + list(cfg.get('ports', []))
+    if not ports and not replay:
+        raise click.UsageError('at least one --port is required')
+    for p in ports:
+        if not source.is_url(p) and not os.path.exists(p):
+            raise click.BadParameter('%s does not exist' % p,
+                                     param_hint='--port')
+    try:
+        polls = hexproto.parse_rates(poll_specs)
+    except ValueError as ex:
+        raise click.BadParameter(str(ex), param_hint='--poll')
+
     exporters = []
+    instruments = instrument.Instruments() if instrumented else None
 
     if prometheus_port:
+        import prometheus_client
+        from . import prometheus
         prometheus_client.start_http_server(prometheus_port)
-        exporters.append(prometheus.Exporter())
+        bank = filters.FilterBank(filter_tau, _parse_filters(filter_kinds))
+        if prometheus_collector:
+            collector = prometheus.Collector(bank)
+            prometheus_client.REGISTRY.register(collector)
+            exporters.append(collector)
+        else:
+            exporters.append(prometheus.Exporter(bank=bank))
 
+    if history_port:
+        from . import history
+        h = history.History(history_samples or history.SAMPLES)
+        history.serve(h, history_port)
+        exporters.append(h)
+
+    if archive_dir:
+        from . import archive
+        a = archive.Exporter(archive_dir,
+                             rotate_bytes=int(archive_rotate_mb * 2**20),
+                             rotate_seconds=archive_rotate_hours * 3600)
+        # Write the pending chunks on exit.
+        atexit.register(a.close)
+        exporters.append(a)
+
+    mqtt_exporter = None
     if mqtt_host:
-        exporters.append(mqtt.Exporter(mqtt_host))
+        from . import mqtt
+        mqtt_exporter = mqtt.Exporter(mqtt_host,
+                                      state_json=mqtt_json,
+                                      qos=mqtt_qos,
+                                      retain=mqtt_retain,
+                                      heartbeat=mqtt_heartbeat,
+                                      policies=_parse_policies(cfg),
+                                      discovery_cache=mqtt_discovery_cache)
+        exporters.append(mqtt_exporter)
+
+    if aggregated:
+        from . import aggregate
+        agg = aggregate.Aggregator(
+            cfg.get('aggregate_labels', aggregate.LABELS),
+            cfg.get('groups'),
+            cfg.get('aggregate_stale', aggregate.STALE),
+            sinks=[mqtt_exporter] if mqtt_exporter else [])
+        if prometheus_port:
+            prometheus_client.REGISTRY.register(aggregate.Collector(agg))
+        exporters.append(agg)
 
     if echo:
-        exporters.append(Echo())
+        exporters.append(Echo(instruments))
+
+    if instruments:
+        if prometheus_port:
+            prometheus_client.REGISTRY.register(instruments)
+        exporters = [instruments.timed(e) for e in exporters]
+
+    if queue_size:
+        p = pipeline.Pipeline(exporters, queue_size, queue_policy,
+                              export_workers)
+        if prometheus_port:
+            prometheus_client.REGISTRY.register(pipeline.Collector(p))
+        exporters = [p]
+
+    if derived:
+        from . import derive
+        d = derive.Deriver(exporters, derive_state)
+        # Save the integrals on exit.
+        atexit.register(d.close)
+        exporters = [d]
+
+    if replay:
+        src = capture.Replay(replay, replay_speed)
+        try:
+            _replay(src, exporters, validate, compact, instruments, replay)
+        except EOFError:
+            pass
+        finally:
+            if queue_size:
+                p.close()
+        return
+
+    if workers > 1:
+        shard.run(ports, exporters, workers, validate, capture_path,
+                  stale_timeout, polls)
+        return
 
-    for fields in text.parse(s):
-        for e in exporters:
-            e.export(fields)
+    aio.run(ports, exporters, validate, compact, capture_path, instruments,
+            stale_timeout, polls)
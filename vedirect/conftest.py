@@ -0,0 +1,44 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Fixtures shared by the tests."""
+
+import pytest
+
+from . import test_text
+from . import text
+
+
+class Collect:
+    """An exporter that keeps every block."""
+    def __init__(self):
+        self.blocks = []
+
+    def export(self, fields):
+        self.blocks.append(fields)
+
+
+@pytest.fixture
+def collect() -> Collect:
+    return Collect()
+
+
+@pytest.fixture
+def parse_blocks():
+    """Returns a function that decodes n copies of test_text._BLOCK."""
+    def parse(n: int = 1, compact: bool = False) -> list:
+        data = (test_text._SYNC + test_text._BLOCK * n).replace(
+            b'\n', b'\r\n')
+        return text.Parser(compact=compact).feed(data)
+
+    return parse
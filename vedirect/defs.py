@@ -15,10 +15,9 @@
 
 import collections
 import enum
+from typing import Callable, Dict
 
-import pint
-
-_ureg = pint.UnitRegistry()
+from . import units
 
 
 class State(enum.IntEnum):
@@ -107,16 +106,24 @@ class Load(enum.IntEnum):
     ON = 1
 
 
+class Scale(collections.namedtuple('Scale', 'factor unit')):
+    """Scale converts a raw value to factor times the named pint unit.
+
+    Units are kept as names so that decoding does not need a registry.
+    """
+
+
 # Kinds maps the common units to the appropriate scale and unit.
 _KINDS = {
-    'mV': 1e-3 * _ureg.volt,
-    'mA': 1e-3 * _ureg.amp,
-    'W': 1 * _ureg.watt,
-    '0.01 kWh': 1e-2 * 1000 * _ureg.watt * _ureg.hour,
-    '0.01 V': 1e-2 * _ureg.volt,
-    '0.1 A': 1e-1 * _ureg.amp,
-    'Seconds': _ureg.second,
-    'HSDS': 1 * _ureg.day,
+    'mV': Scale(1e-3, 'volt'),
+    'mA': Scale(1e-3, 'ampere'),
+    'W': Scale(1, 'watt'),
+    'Wh': Scale(1, 'hour * watt'),
+    '0.01 kWh': Scale(1e-2 * 1000, 'hour * watt'),
+    '0.01 V': Scale(1e-2, 'volt'),
+    '0.1 A': Scale(1e-1, 'ampere'),
+    'Seconds': Scale(1, 'second'),
+    'HSDS': Scale(1, 'day'),
     'ERR': Err,
     'CS': State,
     'MPPT': MPPTMode,
@@ -215,7 +222,110 @@ FIELDS = (
     HSDS,
 )
 
-FIELD_MAP = {x.label: x for x in FIELDS}
+# The product of the inputs.
+PRODUCT = 'product'
+# The trapezoidal integral of the input over time in hours.
+INTEGRAL = 'integral'
+
+
+class Derived(collections.namedtuple('Derived', 'field op inputs')):
+    """Derived describes a field computed from other fields of a block."""
+
+
+PB = Field('PB', 'W', 'Battery power (V * I)')
+EPV = Field('EPV', 'Wh', 'Energy from the panels')
+EB = Field('EB', 'Wh', 'Net energy into the battery')
+
+# Derived fields in the order they are computed, so that later ones
+# may use earlier ones.
+DERIVED = (
+    Derived(PB, PRODUCT, (V.label, I.label)),
+    Derived(EPV, INTEGRAL, (PPV.label, )),
+    Derived(EB, INTEGRAL, (PB.label, )),
+)
+
+FIELD_MAP = {x.label: x for x in FIELDS + tuple(x.field for x in DERIVED)}
+
+# All defined fields, including those that have not been tested.
+KNOWN_FIELD_MAP = {
+    x.label: x
+    for x in list(globals().values()) if isinstance(x, Field)
+}
+
+
+def lookup(label: str) -> Field:
+    """Returns the definition of a field.
+
+    Fields that have not been tested or are not known are returned
+    without a unit so that their raw value is used as is.
+    """
+    f = FIELD_MAP.get(label)
+    if f is not None:
+        return f
+    known = KNOWN_FIELD_MAP.get(label)
+    return Field(label, '', known.description if known else label)
+
+
+# Parsers for certain unique field values.
+_PARSERS = {
+    FW.label: lambda x: '%d.%d' % (int(x) // 100, int(x) % 100),
+    LOAD.label: lambda x: 1 if x == 'ON' else 0,
+}
+
+
+def _decoder(field: Field) -> Callable[[str], object]:
+    """Builds the function that converts a raw value for field."""
+    kind = field.kind()
+    parse = _PARSERS.get(field.label, int)
+
+    if isinstance(kind, Scale):
+        factor, name = kind
+        return lambda x: parse(x) * factor * units.unit(name)
+    if isinstance(kind, type) and issubclass(kind, enum.Enum):
+        return lambda x: kind(parse(x))
+    if kind is str:
+        return _PARSERS.get(field.label, str)
+    assert kind is None, 'Unhandled kind %s' % kind
+    return parse
+
+
+def _raw_decoder(field: Field) -> Callable[[str], object]:
+    """Builds the function that converts a raw value for field to a plain
+    int, float, or str."""
+    kind = field.kind()
+    parse = _PARSERS.get(field.label, int)
+
+    if isinstance(kind, Scale):
+        factor = kind.factor
+        return lambda x: parse(x) * factor
+    if kind is str:
+        return _PARSERS.get(field.label, str)
+    return parse
+
+
+# Maps each label to the function that decodes its raw value. Unknown
+# labels are decoded with int().
+DECODERS = {x.label: _decoder(x)
+            for x in FIELDS}  # type: Dict[str, Callable[[str], object]]
+
+# As DECODERS, but quantities are scaled to a plain number and enums
+# are left as ints.
+RAW_DECODERS = {x.label: _raw_decoder(x)
+                for x in FIELDS}  # type: Dict[str, Callable[[str], object]]
+
+
+# Maps the label of each quantity to the scale applied to the raw
+# value and the name of the unit of the result.
+SCALES = {x.label: x.kind()
+          for x in FIELD_MAP.values()
+          if isinstance(x.kind(), Scale)}  # type: Dict[str, Scale]
+
+# Maps the label of each enum field to its enum type.
+ENUMS = {
+    x.label: x.kind()
+    for x in FIELDS
+    if isinstance(x.kind(), type) and issubclass(x.kind(), enum.Enum)
+}  # type: Dict[str, type]
 
 PIDS = {
     0x203: 'BMV-700',
@@ -0,0 +1,147 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Adds the fields in defs.DERIVED to each block before export.
+
+Integrals use the real time between blocks and are kept in
+compensated sums so that many small steps do not lose precision. They
+persist across restarts if a state file is given.
+"""
+
+import json
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from . import block
+from . import defs
+from . import units
+
+# Blocks further apart than this many seconds are not integrated
+# across, as the value in between is unknown.
+MAX_GAP = 60.0
+
+# Seconds between writes of the state file.
+_SAVE_INTERVAL = 60.0
+
+
+class _Integral:
+    """_Integral is a Kahan compensated running trapezoidal integral."""
+    __slots__ = ('total', 'comp', 'last_t', 'last_v')
+
+    def __init__(self, total: float = 0.0):
+        self.total = total
+        self.comp = 0.0
+        self.last_t = None  # type: Optional[float]
+        self.last_v = 0.0
+
+    def step(self, t: float, v: float, max_gap: float) -> float:
+        if self.last_t is not None and 0 < t - self.last_t <= max_gap:
+            y = (v + self.last_v) / 2 * (t - self.last_t) / 3600 - self.comp
+            total = self.total + y
+            self.comp = (total - self.total) - y
+            self.total = total
+        self.last_t = t
+        self.last_v = v
+        return self.total
+
+
+class Deriver:
+    """Deriver computes derived fields and passes the block on.
+
+    Wrap the exporters in a Deriver to export derived fields like
+    native ones. Blocks from text.parse() get pint quantities and
+    compact blocks get plain values. Integrals are saved to
+    state_path, if set, every minute and on close().
+    """
+    def __init__(self,
+                 exporters: Sequence,
+                 state_path: Optional[str] = None,
+                 table: Sequence[defs.Derived] = defs.DERIVED,
+                 max_gap: float = MAX_GAP):
+        self._exporters = exporters
+        self._state_path = state_path
+        self._table = table
+        self._max_gap = max_gap
+        self._integrals = {}  # type: Dict[Tuple[str, str], _Integral]
+        self._saved = time.monotonic()
+        if state_path and os.path.exists(state_path):
+            with open(state_path) as f:
+                for ser, totals in json.load(f).items():
+                    for label, total in totals.items():
+                        self._integrals[ser, label] = _Integral(total)
+
+    def _integral(self, ser: str, label: str) -> _Integral:
+        i = self._integrals.get((ser, label))
+        if i is None:
+            i = self._integrals[ser, label] = _Integral()
+        return i
+
+    def derive(self, fields):
+        """Returns a copy of the block with the derived fields added."""
+        ser = fields.get(defs.SER.label)
+        compact = isinstance(fields, block.Block)
+        t = block.arrival(fields)
+        values = dict(block.plain(fields))
+        added = []  # type: List[str]
+
+        for d in self._table:
+            inputs = [values.get(x) for x in d.inputs]
+            if not all(isinstance(x, (int, float)) for x in inputs):
+                continue
+            if d.op == defs.PRODUCT:
+                v = 1.0
+                for x in inputs:
+                    v *= x
+            elif d.op == defs.INTEGRAL:
+                if ser is None:
+                    continue
+                v = self._integral(ser, d.field.label).step(
+                    t, inputs[0], self._max_gap)
+            else:
+                raise ValueError('unknown operation %r' % d.op)
+            values[d.field.label] = v
+            added.append(d.field.label)
+
+        if compact:
+            return block.Block(values, t)
+        out = fields.copy()
+        for label in added:
+            scale = defs.SCALES.get(label)
+            out[label] = values[label] * units.unit(
+                scale.unit) if scale else values[label]
+        return out
+
+    def export(self, fields) -> None:
+        fields = self.derive(fields)
+        for e in self._exporters:
+            e.export(fields)
+        if (self._state_path
+                and time.monotonic() - self._saved >= _SAVE_INTERVAL):
+            self.save()
+
+    def save(self) -> None:
+        """Writes the integrals to the state file."""
+        self._saved = time.monotonic()
+        if not self._state_path:
+            return
+        state = {}  # type: Dict[str, Dict[str, float]]
+        for (ser, label), i in self._integrals.items():
+            state.setdefault(ser, {})[label] = i.total
+        tmp = self._state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f, sort_keys=True)
+        os.replace(tmp, self._state_path)
+
+    def close(self) -> None:
+        self.save()
@@ -0,0 +1,118 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Smooths gauge values per device and field."""
+
+import array
+import math
+from typing import Dict, Optional, Tuple
+
+# First order low pass filter with a time constant of tau seconds.
+EMA = 'ema'
+# Mean of the last window samples.
+MEAN = 'mean'
+# Lowest value seen in a hold that restarts every tau seconds.
+MIN = 'min'
+# Highest value seen in a hold that restarts every tau seconds.
+MAX = 'max'
+
+KINDS = (EMA, MEAN, MIN, MAX)
+
+
+class FilterBank:
+    """FilterBank holds one filter per (serial number, label).
+
+    Filters use the real time between samples so that the smoothing
+    does not depend on the block rate. The state of all filters is
+    kept in flat arrays indexed by slot.
+    """
+    def __init__(self,
+                 tau: float = 20.0,
+                 kinds: Optional[Dict[str, str]] = None,
+                 window: int = 16):
+        """Creates a bank.
+
+        tau is the EMA time constant and the MIN/MAX hold time. kinds
+        maps a label to the filter used for it, defaulting to EMA.
+        window is the number of samples averaged by MEAN.
+        """
+        for kind in (kinds or {}).values():
+            if kind not in KINDS:
+                raise ValueError('unknown filter %r' % kind)
+        self._tau = tau
+        self._kinds = kinds or {}
+        self._window = window
+        self._slots = {}  # type: Dict[Tuple[str, str], int]
+        # Filter output, or the running sum for MEAN.
+        self._acc = array.array('d')
+        # Time of the last sample, or the start of the hold for MIN/MAX.
+        self._time = array.array('d')
+        # Non-zero once a sample has been seen. For MEAN, the number
+        # of samples seen, wrapped between window and 2 * window.
+        self._count = array.array('l')
+        # Sample history for MEAN slots, window entries per slot.
+        self._history = array.array('d')
+        self._history_slot = {}  # type: Dict[int, int]
+
+    def _slot(self, ser: str, label: str) -> int:
+        key = (ser, label)
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = len(self._acc)
+            self._acc.append(0)
+            self._time.append(0)
+            self._count.append(0)
+            if self._kinds.get(label) == MEAN:
+                self._history_slot[slot] = len(self._history)
+                self._history.extend([0] * self._window)
+        return slot
+
+    def step(self, ser: str, label: str, v: float, now: float) -> float:
+        """Adds a sample taken at now seconds and returns the output."""
+        slot = self._slot(ser, label)
+        kind = self._kinds.get(label, EMA)
+        count = self._count[slot]
+        acc = self._acc[slot]
+
+        if kind == EMA:
+            if count:
+                dt = now - self._time[slot]
+                alpha = 1 - math.exp(-max(dt, 0) / self._tau)
+                acc += (v - acc) * alpha
+            else:
+                acc = v
+            self._time[slot] = now
+        elif kind == MEAN:
+            base = self._history_slot[slot]
+            idx = base + count % self._window
+            if count >= self._window:
+                acc -= self._history[idx]
+            self._history[idx] = v
+            acc += v
+            self._acc[slot] = acc
+            self._count[slot] = count + 1
+            # Wrap the count to keep it small while marking it as full.
+            if count + 1 == 2 * self._window:
+                self._count[slot] = self._window
+            return acc / min(count + 1, self._window)
+        else:
+            better = min if kind == MIN else max
+            if count == 0 or now - self._time[slot] >= self._tau:
+                acc = v
+                self._time[slot] = now
+            else:
+                acc = better(acc, v)
+
+        self._acc[slot] = acc
+        self._count[slot] = 1
+        return acc
@@ -0,0 +1,337 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""The VE.Direct HEX protocol and a register polling scheduler.
+
+A HEX frame is a ':', a command nibble, the data bytes, and a
+checksum byte, all as hex digits, and a LF. The nibble, data, and
+checksum sum to 0x55. HEX frames may be interleaved with the TEXT
+protocol on the same line, so Demux splits them out before the TEXT
+parser sees the stream.
+"""
+
+import collections
+import re
+import struct
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from . import block
+from . import defs
+from . import text
+
+# Commands sent to the device.
+PING = 0x1
+APP_VERSION = 0x3
+PRODUCT_ID = 0x4
+RESTART = 0x6
+GET = 0x7
+SET = 0x8
+# Responses from the device. GET, SET, and ASYNC responses share the
+# layout of a register id, flags, and value.
+DONE = 0x1
+UNKNOWN = 0x3
+ERROR = 0x4
+PING_RESPONSE = 0x5
+ASYNC = 0xA
+
+# Flags of a register response.
+FLAG_UNKNOWN_ID = 0x01
+FLAG_NOT_SUPPORTED = 0x02
+FLAG_PARAMETER_ERROR = 0x04
+
+# Bytes per second of a 19200 baud 8N1 line.
+LINE_RATE = 1920
+
+# Longest HEX frame that is buffered while incomplete.
+_MAX_FRAME = 128
+
+_FRAME = re.compile(rb':([0-9A-Fa-f]{3,})\n')
+_PARTIAL = re.compile(rb':[0-9A-Fa-f]*')
+
+_REGISTER = struct.Struct('<HB')
+
+
+class Frame(collections.namedtuple('Frame', 'command data')):
+    """Frame is a decoded HEX frame without its checksum."""
+
+
+def encode(command: int, data: bytes = b'') -> bytes:
+    """Returns the HEX frame for a command and its data."""
+    check = (0x55 - command - sum(data)) & 0xFF
+    return b':%X%s%02X\n' % (command, data.hex().upper().encode(), check)
+
+
+def decode(digits: bytes) -> Frame:
+    """Decodes the hex digits between the ':' and LF of a frame.
+
+    Raises ValueError if the frame is malformed or the checksum is
+    wrong.
+    """
+    if len(digits) % 2 == 0:
+        raise ValueError('frame has an even number of digits')
+    command = int(digits[:1], 16)
+    data = bytes.fromhex(digits[1:].decode())
+    if (command + sum(data)) & 0xFF != 0x55:
+        raise ValueError('bad checksum in :%s' % digits.decode())
+    return Frame(command, data[:-1])
+
+
+def get(register: int) -> bytes:
+    """Returns the frame that reads a register."""
+    return encode(GET, _REGISTER.pack(register, 0))
+
+
+def parse_register(frame: Frame) -> Tuple[int, int, bytes]:
+    """Returns the register id, flags, and value of a GET, SET, or ASYNC
+    response."""
+    if len(frame.data) < _REGISTER.size:
+        raise ValueError('short register frame')
+    register, flags = _REGISTER.unpack_from(frame.data)
+    return register, flags, frame.data[_REGISTER.size:]
+
+
+class Demux:
+    """Demux separates HEX frames from the TEXT protocol.
+
+    A ':' starts a frame only if it is followed by hex digits and a LF,
+    so the TEXT checksum byte may be a ':'. Incomplete frames are held
+    until the next feed. Frames with a bad checksum are dropped and
+    counted in errors.
+    """
+    def __init__(self):
+        self._pending = b''
+        self.errors = 0
+
+    def feed(self, data: bytes) -> Tuple[bytes, List[Frame]]:
+        """Returns the TEXT bytes and the HEX frames in data."""
+        if self._pending:
+            data = self._pending + data
+            self._pending = b''
+        if b':' not in data:
+            return data, []
+
+        plain = bytearray()
+        frames = []
+        pos = 0
+        while True:
+            i = data.find(b':', pos)
+            if i < 0:
+                plain += data[pos:]
+                break
+            plain += data[pos:i]
+            m = _FRAME.match(data, i)
+            if m:
+                try:
+                    frames.append(decode(m.group(1)))
+                except ValueError:
+                    self.errors += 1
+                pos = m.end()
+                continue
+            if (len(data) - i < _MAX_FRAME
+                    and _PARTIAL.fullmatch(data, i)):
+                # Possibly the start of a frame.
+                self._pending = data[i:]
+                break
+            plain += b':'
+            pos = i + 1
+        return bytes(plain), frames
+
+
+class Register(
+        collections.namedtuple('Register', 'id label format scale')):
+    """Register maps a device register to a field.
+
+    The value is unpacked with the struct format and multiplied by
+    scale to give the plain value of the field, as in a block.Block.
+    """
+
+
+# Registers of the BlueSolar and SmartSolar MPPT chargers.
+REGISTERS = (
+    Register(0x0201, defs.CS.label, '<B', 1),
+    Register(0xEDD5, defs.V.label, '<H', 0.01),
+    Register(0xEDD7, defs.I.label, '<H', 0.1),
+    Register(0xEDBB, defs.VPV.label, '<H', 0.01),
+    Register(0xEDBC, defs.PPV.label, '<I', 0.01),
+    Register(0xEDAD, defs.IL.label, '<H', 0.1),
+)
+
+REGISTER_MAP = {x.label: x for x in REGISTERS}
+
+
+class Scheduler:
+    """Scheduler decides when to poll each register.
+
+    Each register is polled every rates[id] seconds, within a budget
+    of the given fraction of the line rate for the requests and
+    responses together. Registers that do not fit the budget fall
+    behind instead of bursting.
+    """
+    def __init__(self,
+                 rates: Dict[int, float],
+                 registers: Sequence[Register] = REGISTERS,
+                 budget: float = 0.5):
+        self._registers = {x.id: x for x in registers}
+        for register in rates:
+            if register not in self._registers:
+                raise ValueError('unknown register 0x%04X' % register)
+        self._rates = rates
+        self._bytes_per_s = budget * LINE_RATE
+        # Bytes that may be sent now, up to a second's worth.
+        self._tokens = self._bytes_per_s
+        self._last = None  # type: Optional[float]
+        self._next = {x: 0.0 for x in rates}  # type: Dict[int, float]
+
+    def _cost(self, register: int) -> int:
+        """Returns the bytes of a request and its response."""
+        size = struct.calcsize(self._registers[register].format)
+        # The response is the request with the value added.
+        return 2 * len(get(register)) + 2 * size
+
+    def due(self, now: float) -> List[bytes]:
+        """Returns the frames to send now, most overdue first."""
+        if self._last is not None:
+            self._tokens = min(self._tokens + (now - self._last) *
+                               self._bytes_per_s, self._bytes_per_s)
+        self._last = now
+        frames = []
+        for register in sorted(self._next, key=self._next.get):
+            if self._next[register] > now:
+                break
+            if self._tokens < 0:
+                # Wait until the last request has been paid for.
+                break
+            self._tokens -= self._cost(register)
+            self._next[register] = now + self._rates[register]
+            frames.append(get(register))
+        return frames
+
+    def wait(self, now: float) -> float:
+        """Returns the seconds until a register is next due."""
+        if not self._next:
+            return float('inf')
+        debt = -self._tokens / self._bytes_per_s
+        return max(min(self._next.values()) - now, debt, 0.0)
+
+
+class Session:
+    """Session reads TEXT blocks and polls registers on one port.
+
+    feed is the TEXT parser's feed(), such as text.Parser.feed, and
+    write sends bytes to the device. A register value replaces the
+    block's own value of a field only in the first block after it was
+    received, so a stale reply never hides a fresh TEXT value. Fields
+    the TEXT protocol does not send are merged into each following
+    block for up to three poll intervals, or 10 seconds for registers
+    that are only sent asynchronously.
+
+    As values are merged into the TEXT blocks, which are sent once a
+    second, polling faster than that does not give more samples.
+    """
+    def __init__(self,
+                 feed: Callable[[bytes], list],
+                 write: Callable[[bytes], object],
+                 rates: Dict[int, float],
+                 registers: Sequence[Register] = REGISTERS,
+                 budget: float = 0.5):
+        self._feed = feed
+        self._write = write
+        self._registers = {x.id: x for x in registers}
+        self._ttl = {x: max(3 * rate, 10.0) for x, rate in rates.items()}
+        self.scheduler = Scheduler(rates, registers, budget)
+        self.demux = Demux()
+        # Maps the label to the plain value, when it expires, and when
+        # it was received.
+        self._values = {}  # type: Dict[str, Tuple[object, float, float]]
+        # When the last block was returned.
+        self._last_block = float('-inf')
+
+    def poll(self, now: Optional[float] = None) -> float:
+        """Sends the due requests. Returns the seconds until the next."""
+        if now is None:
+            now = time.monotonic()
+        for frame in self.scheduler.due(now):
+            self._write(frame)
+        return self.scheduler.wait(now)
+
+    def _on_frame(self, frame: Frame, now: float) -> None:
+        if frame.command not in (GET, SET, ASYNC):
+            return
+        register, flags, value = parse_register(frame)
+        r = self._registers.get(register)
+        if r is None or flags:
+            return
+        size = struct.calcsize(r.format)
+        if len(value) < size:
+            return
+        raw = struct.unpack_from(r.format, value)[0]
+        v = raw * r.scale if r.scale != 1 else raw
+        self._values[r.label] = (v, now + self._ttl.get(register, 10.0),
+                                 now)
+
+    def _merge(self, fields, now: float, since: float):
+        """Merges in the values that are not expired and, for fields in
+        the block, were received after since."""
+        fresh = {
+            label: v
+            for label, (v, expires, received) in self._values.items()
+            if now < expires and (received > since or label not in fields)
+        }
+        if not fresh:
+            return fields
+        if isinstance(fields, block.Block):
+            values = dict(fields.items())
+            values.update(fresh)
+            return block.Block(values, fields.time)
+        # Convert to the same types as the TEXT parser gives.
+        converted = block.Block(fresh)
+        out = fields.copy()
+        out.update((label, converted.value(label)) for label in fresh)
+        return out
+
+    def feed(self, data: bytes, now: Optional[float] = None) -> list:
+        """Handles data read from the device and returns the completed
+        blocks with the register values merged in."""
+        if now is None:
+            now = time.monotonic()
+        stream, frames = self.demux.feed(data)
+        for frame in frames:
+            self._on_frame(frame, now)
+        if not stream:
+            return []
+        since = self._last_block
+        try:
+            blocks = self._feed(stream)
+        except text.ProtocolError as ex:
+            if ex.blocks:
+                self._last_block = now
+            ex.blocks = [self._merge(x, now, since) for x in ex.blocks]
+            raise
+        if blocks:
+            self._last_block = now
+        return [self._merge(x, now, since) for x in blocks]
+
+
+def parse_rates(specs: Sequence[str]) -> Dict[int, float]:
+    """Parses REGISTER=SECONDS specs, where REGISTER is a field label
+    from REGISTERS or a register id in hex."""
+    rates = {}
+    for spec in specs:
+        name, _, seconds = spec.partition('=')
+        r = REGISTER_MAP.get(name)
+        register = r.id if r else int(name, 16)
+        if register not in [x.id for x in REGISTERS]:
+            raise ValueError('unknown register %s' % name)
+        rates[register] = float(seconds)
+    return rates
@@ -0,0 +1,242 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Keeps a bounded in-memory history of every numeric field.
+
+Each (serial number, label) has a ring of raw samples and rings of
+min/max/mean rollups over fixed periods. All rings are preallocated
+arrays, so memory is fixed by the number of series and queries only
+touch the requested window.
+"""
+
+import array
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from . import block
+
+# Default rollup periods in seconds and the number of each kept:
+# 4 hours of minutes, a day of quarter hours, and a week of hours.
+ROLLUPS = ((60, 240), (900, 96), (3600, 168))
+
+# Default number of raw samples kept per series.
+SAMPLES = 600
+
+
+class _Ring:
+    """_Ring holds the newest rows of a table, one array per column.
+
+    The first column is the time, which must not decrease.
+    """
+    def __init__(self, size: int, columns: int):
+        self.size = size
+        self.cols = [
+            array.array('d', bytes(8 * size)) for _ in range(columns)
+        ]
+        # Number of rows ever appended.
+        self.count = 0
+
+    def append(self, row: Sequence[float]) -> None:
+        i = self.count % self.size
+        for col, v in zip(self.cols, row):
+            col[i] = v
+        self.count += 1
+
+    def rows(self, since: float, until: float) -> List[Tuple[float, ...]]:
+        """Returns the rows with since <= time < until, oldest first."""
+        size = self.size
+        times = self.cols[0]
+        lo = max(self.count - size, 0)
+        hi = self.count
+        # Binary search over the logical index for the first row.
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[mid % size] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        out = []
+        for k in range(lo, self.count):
+            i = k % size
+            if times[i] >= until:
+                break
+            out.append(tuple(col[i] for col in self.cols))
+        return out
+
+
+class Series:
+    """Series holds the raw samples and rollups of one field."""
+    def __init__(self, samples: int, rollups: Sequence[Tuple[int, int]]):
+        self.raw = _Ring(samples, 2)
+        self.periods = [period for period, _ in rollups]
+        # Columns are start, min, max, sum, and count.
+        self.rollups = [_Ring(n, 5) for _, n in rollups]
+        # The rollup currently being filled for each period.
+        self._open = [array.array('d', bytes(8 * 5)) for _ in rollups]
+
+    def add(self, t: float, v: float) -> None:
+        self.raw.append((t, v))
+        for period, ring, cur in zip(self.periods, self.rollups, self._open):
+            start = t - t % period
+            if cur[4] and start != cur[0]:
+                ring.append(cur)
+                cur[4] = 0
+            if cur[4]:
+                cur[1] = min(cur[1], v)
+                cur[2] = max(cur[2], v)
+                cur[3] += v
+                cur[4] += 1
+            else:
+                cur[0] = start
+                cur[1] = cur[2] = cur[3] = v
+                cur[4] = 1
+
+    def query(self, since: float, until: float,
+              period: int = 0) -> List[dict]:
+        """Returns the raw samples or the rollups of a period in the
+        window."""
+        if not period:
+            return [{
+                'time': t,
+                'value': v
+            } for t, v in self.raw.rows(since, until)]
+
+        j = self.periods.index(period)
+        rows = self.rollups[j].rows(since, until)
+        cur = self._open[j]
+        if cur[4] and since <= cur[0] < until:
+            rows.append(tuple(cur))
+        return [{
+            'time': start,
+            'min': lo,
+            'max': hi,
+            'mean': total / n
+        } for start, lo, hi, total, n in rows]
+
+
+class History:
+    """History records every numeric field of each block.
+
+    Use as an exporter. Strings are skipped. Safe to query from
+    another thread.
+    """
+    def __init__(self,
+                 samples: int = SAMPLES,
+                 rollups: Sequence[Tuple[int, int]] = ROLLUPS):
+        self._samples = samples
+        self._rollups = rollups
+        self._series = {}  # type: Dict[Tuple[str, str], Series]
+        self._lock = threading.Lock()
+
+    def bytes_per_series(self) -> int:
+        """Returns the memory used by the arrays of one series."""
+        return 8 * (2 * self._samples +
+                    5 * sum(n + 1 for _, n in self._rollups))
+
+    def export(self, fields: dict) -> None:
+        ser = fields.get('SER#')
+        if ser is None:
+            return
+        now = block.arrival(fields)
+        with self._lock:
+            for label, value in block.plain(fields):
+                if isinstance(value, str):
+                    continue
+                s = self._series.get((ser, label))
+                if s is None:
+                    s = self._series[ser, label] = Series(
+                        self._samples, self._rollups)
+                s.add(now, value)
+
+    def series(self) -> List[Tuple[str, str]]:
+        """Returns the serial number and label of every series."""
+        with self._lock:
+            return sorted(self._series)
+
+    def query(self,
+              ser: str,
+              label: str,
+              since: float,
+              until: float = float('inf'),
+              period: int = 0) -> Optional[List[dict]]:
+        """Returns the samples of a field in [since, until).
+
+        period selects one of the rollup periods instead of the raw
+        samples. Returns None if the field has not been seen.
+        """
+        if period and period not in [p for p, _ in self._rollups]:
+            raise ValueError('no %d s rollup' % period)
+        with self._lock:
+            s = self._series.get((ser, label))
+            return s.query(since, until, period) if s else None
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Serves /history and /history/<serial number>/<label>.
+
+    The query parameters are since and until in seconds since the
+    epoch, or relative to now if negative, and period.
+    """
+    history = None  # type: History
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        url = urllib.parse.urlsplit(self.path)
+        parts = [urllib.parse.unquote(x) for x in url.path.split('/') if x]
+        args = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            if parts == ['history']:
+                body = [{
+                    'serial_number': ser,
+                    'field': label
+                } for ser, label in self.history.series()]
+            elif len(parts) == 3 and parts[0] == 'history':
+                now = time.time()
+                since = float(args.get('since', -600))
+                until = float(args.get('until', now))
+                body = self.history.query(
+                    parts[1], parts[2], since + now if since < 0 else since,
+                    until + now if until < 0 else until,
+                    int(args.get('period', 0)))
+                if body is None:
+                    self.send_error(404)
+                    return
+            else:
+                self.send_error(404)
+                return
+        except ValueError as ex:
+            self.send_error(400, str(ex))
+            return
+
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+def serve(history: History,
+          port: int,
+          addr: str = '') -> http.server.ThreadingHTTPServer:
+    """Serves queries of history on a daemon thread."""
+    handler = type('Handler', (_Handler, ), {'history': history})
+    server = http.server.ThreadingHTTPServer((addr, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,214 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measures the reader, decoder, and exporters of this process.
+
+Measurements are kept in plain counters and only converted to
+Prometheus metrics when scraped, so they are cheap enough to leave on.
+"""
+
+import array
+import bisect
+import time
+from typing import Callable, Dict, List, Optional
+
+from . import text
+
+# Upper bounds in seconds of the histogram buckets.
+_BUCKETS = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1.0,
+            3.0)
+
+
+class Histogram:
+    """A fixed bucket histogram of durations."""
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        # The last bucket is +Inf.
+        self.counts = array.array('l', [0] * (len(_BUCKETS) + 1))
+        self.sum = 0.0
+
+    def observe(self, v: float) -> None:
+        self.counts[bisect.bisect_left(_BUCKETS, v)] += 1
+        self.sum += v
+
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def buckets(self) -> List:
+        """Returns the cumulative buckets in prometheus_client form."""
+        # prometheus_client is only needed once metrics are collected.
+        # pylint: disable=import-outside-toplevel
+        from prometheus_client import utils
+        out = []
+        total = 0
+        for le, n in zip(_BUCKETS + (float('inf'), ), self.counts):
+            total += n
+            out.append((utils.floatToGoString(le), total))
+        return out
+
+
+class Port:
+    """Port measures the reads and decoding of one source."""
+    def __init__(self, parser: text.Parser):
+        self.parser = parser
+        self.bytes = 0
+        self.reads = 0
+        self.empty_reads = 0
+        self.reconnects = 0
+        self.decode = Histogram()
+
+    def feed(self,
+             data: bytes,
+             now: Optional[float] = None) -> List[text.Fields]:
+        """Feeds data that arrived at now to the parser and returns the
+        completed blocks."""
+        self.reads += 1
+        if not data:
+            self.empty_reads += 1
+            return []
+        self.bytes += len(data)
+        start = time.perf_counter()
+        blocks = self.parser.feed(data, now)
+        self.decode.observe(time.perf_counter() - start)
+        return blocks
+
+    def fill(self,
+             readinto: Callable[[memoryview], int]) -> List[text.Fields]:
+        """As feed(), but the parser reads straight from the source."""
+        self.reads += 1
+        start = time.perf_counter()
+        got, blocks = self.parser.fill(readinto)
+        if not got:
+            self.empty_reads += 1
+            return []
+        self.bytes += got
+        self.decode.observe(time.perf_counter() - start)
+        return blocks
+
+
+class Timed:
+    """Timed wraps an exporter and measures each export() call.
+
+    The latency from the first byte of a block to the end of export()
+    is also measured.
+    """
+    def __init__(self, exporter):
+        self.exporter = exporter
+        self.duration = Histogram()
+        self.latency = Histogram()
+
+    def export(self, fields) -> None:
+        start = time.perf_counter()
+        self.exporter.export(fields)
+        self.duration.observe(time.perf_counter() - start)
+        # Blocks from text.Parser record when they arrived.
+        arrived = getattr(fields, 'time', 0.0)
+        if arrived:
+            self.latency.observe(time.time() - arrived)
+
+
+class Instruments:
+    """Instruments holds the measurements of all ports and exporters.
+
+    Register with prometheus_client.REGISTRY.register().
+    """
+    def __init__(self):
+        self.ports = {}  # type: Dict[str, Port]
+        self.exporters = {}  # type: Dict[str, Timed]
+
+    def port(self, name: str, parser: text.Parser) -> Port:
+        p = self.ports[name] = Port(parser)
+        return p
+
+    def timed(self, exporter, name: Optional[str] = None) -> Timed:
+        t = Timed(exporter)
+        if name is None:
+            kind = type(exporter)
+            name = '%s.%s' % (kind.__module__.split('.')[-1], kind.__name__)
+        self.exporters[name] = t
+        return t
+
+    def collect(self):
+        # pylint: disable=import-outside-toplevel
+        from prometheus_client import core
+        read_bytes = core.CounterMetricFamily('victron_read_bytes',
+                                              'Bytes read from the port',
+                                              labels=['port'])
+        reads = core.CounterMetricFamily('victron_reads',
+                                         'Read calls on the port',
+                                         labels=['port'])
+        empty = core.CounterMetricFamily(
+            'victron_empty_reads',
+            'Read calls on the port that returned no data',
+            labels=['port'])
+        reconnects = core.CounterMetricFamily(
+            'victron_reconnects',
+            'Times the port was reopened after failing or going stale',
+            labels=['port'])
+        decode = core.HistogramMetricFamily(
+            'victron_decode_seconds',
+            'Time spent decoding each read, including the read for '
+            'sources that read into the parser buffer',
+            labels=['port'])
+        parsed = core.CounterMetricFamily(
+            'victron_parsed_blocks',
+            'Blocks seen by a validating parser by outcome',
+            labels=['port', 'result'])
+
+        for name, p in list(self.ports.items()):
+            read_bytes.add_metric([name], p.bytes)
+            reads.add_metric([name], p.reads)
+            empty.add_metric([name], p.empty_reads)
+            reconnects.add_metric([name], p.reconnects)
+            decode.add_metric([name], p.decode.buckets(), p.decode.sum)
+            for result in text.Stats.__slots__:
+                parsed.add_metric([name, result],
+                                  getattr(p.parser.stats, result))
+
+        duration = core.HistogramMetricFamily(
+            'victron_export_seconds',
+            'Time spent in export() for each block',
+            labels=['exporter'])
+        latency = core.HistogramMetricFamily(
+            'victron_block_latency_seconds',
+            'Time from the first byte of a block to the end of export()',
+            labels=['exporter'])
+        for name, t in list(self.exporters.items()):
+            duration.add_metric([name], t.duration.buckets(),
+                                t.duration.sum)
+            if t.latency.count():
+                latency.add_metric([name], t.latency.buckets(),
+                                   t.latency.sum)
+
+        return [
+            read_bytes, reads, empty, reconnects, decode, parsed, duration,
+            latency
+        ]
+
+    def summary(self) -> str:
+        """Returns a one line summary of the measurements."""
+        parts = []
+        for name, p in self.ports.items():
+            s = p.parser.stats
+            parts.append(
+                '%s: %d bytes %d reads (%d empty) decode %.1f us/read '
+                'valid=%d bad_checksum=%d framing_errors=%d' %
+                (name, p.bytes, p.reads, p.empty_reads,
+                 p.decode.sum / max(p.decode.count(), 1) * 1e6, s.valid,
+                 s.bad_checksum, s.framing_errors))
+        for name, t in self.exporters.items():
+            parts.append('%s: %.1f us/block' %
+                         (name, t.duration.sum / max(t.duration.count(), 1) *
+                          1e6))
+        return '; '.join(parts)
@@ -13,14 +13,16 @@
 # limitations under the License.
 """Exports fields over MQTT with discovery."""
 
-import enum
+import collections
+import hashlib
 import json
+import os
 import time
-from typing import Dict, Optional
+from typing import Dict, Iterable, Optional, Set, Tuple
 
 import paho.mqtt.client as mqtt
-import pint
 
+from . import block
 from . import defs
 
 _UNITS = {
@@ -31,27 +33,130 @@ _UNITS = {
 }
 
 
+class Policy(collections.namedtuple('Policy', 'deadband min_interval')):
+    """Policy decides when a changed field is published.
+
+    A number is changed when it differs from the last published value
+    by at least deadband, so a deadband of a counter's resolution
+    publishes every step. A changed field is published once at least
+    min_interval seconds have passed since it was last published.
+    """
+
+
+# Tolerance when comparing a change to a deadband, so that a change of
+# exactly one deadband in floats, like 12.1 - 12.05, is not skipped.
+_EPSILON = 1e-9
+
+# Enums and strings are published as soon as they change.
+_ON_CHANGE = Policy(0, 0)
+
+# Default policies for quantities by unit.
+_POLICIES = {
+    'volt': Policy(0.05, 10),
+    'ampere': Policy(0.1, 10),
+    'watt': Policy(5, 10),
+    'hour * watt': Policy(10, 60),
+}
+
+_DEFAULT_POLICY = Policy(0, 60)
+
+
+def _default_policy(label: str) -> Policy:
+    if label in defs.SCALES:
+        return _POLICIES.get(defs.SCALES[label].unit, _DEFAULT_POLICY)
+    if label in defs.ENUMS or defs.lookup(label).kind() is str:
+        return _ON_CHANGE
+    return _DEFAULT_POLICY
+
+
+def _payload(value: object) -> object:
+    if isinstance(value, (int, float)):
+        return round(value, 3)
+    return str(value)
+
+
 class Exporter:
-    def __init__(self, host: str, port: int = 1883):
-        self._last = None  # type: Optional[float]
+    """Exporter publishes each field to its own topic.
 
-        self._client = mqtt.Client()
-        self._client.connect_async(host, port, 60)
-        self._client.loop_start()
+    Fields of each device are published when they change according to
+    their Policy, and at least every heartbeat seconds so that they do
+    not expire in Home Assistant. policies overrides the policy of a
+    label.
 
-    def _config(self, ser: str, fields: dict) -> None:
-        for label, value in fields.items():
-            f = defs.FIELD_MAP[label]
+    If state_json is set, each block is instead published as a single
+    JSON object to tele/victron_<ser>/state whenever any field is due,
+    and the discovery records extract each field with a value_template.
+
+    Discovery records are published for each label of each device the
+    first time it is seen, and again after each (re)connect for any
+    record that could not be sent. If discovery_cache is set, a hash of
+    each sent record is kept in that file so that unchanged records are
+    not republished after a restart.
+
+    client replaces the connection to host, such as for testing.
+    """
+    def __init__(self,
+                 host: str,
+                 port: int = 1883,
+                 state_json: bool = False,
+                 qos: int = 0,
+                 retain: bool = False,
+                 heartbeat: float = 300,
+                 policies: Optional[Dict[str, Policy]] = None,
+                 discovery_cache: Optional[str] = None,
+                 client: Optional[mqtt.Client] = None):
+        # Maps the serial number to the labels with discovery records.
+        self._discovered = {}  # type: Dict[str, Set[str]]
+        self._discovery_cache = discovery_cache
+        # Maps each discovery topic to the hash of the last payload
+        # published on it.
+        self._discovery_hashes = {}  # type: Dict[str, str]
+        self._hashes_dirty = False
+        # Set by the network thread on connect.
+        self._connected = False
+        if discovery_cache and os.path.exists(discovery_cache):
+            with open(discovery_cache) as f:
+                self._discovery_hashes = json.load(f)
+        self._state_json = state_json
+        self._qos = qos
+        self._retain = retain
+        self._heartbeat = heartbeat
+        self._policies = {}  # type: Dict[str, Policy]
+        self._overrides = policies or {}
+        # Maps (serial number, label) to the last published value and
+        # when it was published.
+        self._published = {}  # type: Dict[Tuple[str, str], Tuple]
+
+        if client is None:
+            client = mqtt.Client()
+            client.on_connect = self._on_connect
+            client.connect_async(host, port, 60)
+            client.loop_start()
+        self._client = client
+
+    def _on_connect(self, *_) -> None:
+        self._connected = True
+
+    def _config(self, ser: str, fields, labels: Iterable[str]) -> None:
+        """Publishes the discovery records of the given labels."""
+        values = dict(block.plain(fields))
+        for label in labels:
+            value = values[label]
+            f = defs.lookup(label)
             labelc = f.label.replace('#', '').lower()
             device = {
                 'ids': [ser],
             }  # type: Dict[str, object]
             if f == defs.PID:
+                try:
+                    model = defs.PIDS[int(value, 16)]
+                except (KeyError, ValueError):
+                    model = value
                 device.update({
                     'manufacturer': 'Victron',
-                    'model': defs.PIDS[int(value, 16)],
+                    'model': model,
                     'name': f'Victron {ser}',
-                    'sw_version': fields[defs.FW.label],
+                    'sw_version': values.get(defs.FW.label),
                 })
 
             config = {
@@ -61,36 +166,104 @@ class Exporter:
                 'expire_after': 600,
                 'device': device,
             }
-            if isinstance(value, pint.Quantity):
-                unit = str(value.units)
+            if self._state_json:
+                config['state_topic'] = f'tele/victron_{ser}/state'
+                config['value_template'] = '{{ value_json.%s }}' % labelc
+            if label in defs.SCALES:
+                unit = defs.SCALES[label].unit
                 unit, klass = _UNITS.get(unit, (unit, None))
                 config['unit_of_measurement'] = unit
                 if klass:
                     config['device_class'] = klass
 
-            self._client.publish(
-                f'homeassistant/sensor/victron_{ser}_{labelc}/config',
-                json.dumps(config),
-                retain=True)
+            topic = f'homeassistant/sensor/victron_{ser}_{labelc}/config'
+            payload = json.dumps(config)
+            digest = hashlib.sha256(payload.encode()).hexdigest()
+            if self._discovery_hashes.get(topic) == digest:
+                continue
+            info = self._client.publish(topic, payload, retain=True)
+            # Publishing before the client connects drops the record,
+            # so only remember it once it was sent.
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                self._discovery_hashes[topic] = digest
+                self._hashes_dirty = True
+
+    def _save_hashes(self) -> None:
+        """Writes the discovery hashes to the cache file."""
+        if not self._discovery_cache or not self._hashes_dirty:
+            return
+        tmp = self._discovery_cache + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._discovery_hashes, f, sort_keys=True)
+        os.replace(tmp, self._discovery_cache)
+        self._hashes_dirty = False
+
+    def _policy(self, label: str) -> Policy:
+        policy = self._policies.get(label)
+        if policy is None:
+            policy = self._overrides.get(label) or _default_policy(label)
+            self._policies[label] = policy
+        return policy
+
+    def _due(self, ser: str, label: str, value: object, now: float) -> bool:
+        """Returns True and records the value if it should be published."""
+        key = (ser, label)
+        last = self._published.get(key)
+        if last is not None:
+            elapsed = now - last[1]
+            if elapsed < self._heartbeat:
+                policy = self._policy(label)
+                if elapsed < policy.min_interval:
+                    return False
+                if isinstance(value, (int, float)) and isinstance(
+                        last[0], (int, float)):
+                    change = abs(value - last[0])
+                    if not change or change < policy.deadband - _EPSILON:
+                        return False
+                elif value == last[0]:
+                    return False
+        self._published[key] = (value, now)
+        return True
 
     def export(self, fields: dict) -> None:
+        if self._connected:
+            # Retry the discovery records that were not sent.
+            self._connected = False
+            self._discovered.clear()
         ser = fields[defs.SER.label]
-        if self._last is None:
-            self._config(ser, fields)
-        elif (time.time() - self._last) < 60:
-            return
+        discovered = self._discovered.setdefault(ser, set())
+        if not discovered.issuperset(fields):
+            labels = [x for x in fields if x not in discovered]
+            self._config(ser, fields, labels)
+            discovered.update(labels)
+            self._save_hashes()
 
-        self._last = time.time()
+        now = time.monotonic()
 
-        for label, value in fields.items():
+        if self._state_json:
+            due = [
+                self._due(ser, label, value, now)
+                for label, value in block.plain(fields)
+            ]
+            if not any(due):
+                return
+            state = {}
+            for label, value in block.plain(fields):
+                self._published[(ser, label)] = (value, now)
+                state[label.replace('#', '').lower()] = _payload(value)
+            self._client.publish(f'tele/victron_{ser}/state',
+                                 json.dumps(state),
+                                 qos=self._qos,
+                                 retain=self._retain)
+            return
+
+        for label, value in block.plain(fields):
+            if not self._due(ser, label, value, now):
+                continue
             name = label.replace('#', '').lower()
             topic = f'tele/victron_{ser}/{name}'
 
-            if isinstance(value, pint.Quantity):
-                payload = round(value.m, 3)
-            elif isinstance(value, enum.IntEnum):
-                payload = int(value)
-            else:
-                payload = str(value)
-
-            self._client.publish(topic, payload)
+            self._client.publish(topic,
+                                 _payload(value),
+                                 qos=self._qos,
+                                 retain=self._retain)
@@ -0,0 +1,144 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Decouples reading from exporting with a bounded queue."""
+
+import collections
+import logging
+import threading
+from typing import Deque, Dict, Optional, Sequence
+
+from . import defs
+
+# Blocks the reader until there is room.
+BLOCK = 'block'
+# Drops the oldest queued block to make room.
+DROP_OLDEST = 'drop-oldest'
+# Keeps only the newest queued block of each device.
+LATEST = 'latest'
+
+POLICIES = (BLOCK, DROP_OLDEST, LATEST)
+
+
+class Pipeline:
+    """Pipeline queues blocks and exports them from worker threads.
+
+    Pipeline is itself an exporter: export() only queues the block, so
+    a slow exporter never stalls the reader unless the policy is
+    BLOCK. When there is more than one worker, different exporters
+    are called concurrently and blocks may be exported out of order,
+    but each exporter is only called by one worker at a time as none
+    of them are thread safe.
+    """
+    def __init__(self,
+                 exporters: Sequence,
+                 maxsize: int = 100,
+                 policy: str = DROP_OLDEST,
+                 workers: int = 1):
+        if policy not in POLICIES:
+            raise ValueError('unknown policy %r' % policy)
+        self._exporters = exporters
+        self._locks = [threading.Lock() for _ in exporters]
+        self._maxsize = maxsize
+        self._policy = policy
+        self._cond = threading.Condition()
+        # For LATEST, the queue holds serial numbers and the block
+        # itself is in _pending.
+        self._queue = collections.deque()  # type: Deque
+        self._pending = {}  # type: Dict[str, object]
+        self._closed = False
+        self.dropped = 0
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True)
+            for _ in range(workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def export(self, fields) -> None:
+        with self._cond:
+            if self._policy == LATEST:
+                ser = fields.get(defs.SER.label)
+                if ser in self._pending:
+                    self.dropped += 1
+                else:
+                    if len(self._queue) >= self._maxsize:
+                        self._pending.pop(self._queue.popleft(), None)
+                        self.dropped += 1
+                    self._queue.append(ser)
+                self._pending[ser] = fields
+            else:
+                if len(self._queue) >= self._maxsize:
+                    if self._policy == BLOCK:
+                        self._cond.wait_for(
+                            lambda: len(self._queue) < self._maxsize)
+                    else:
+                        self._queue.popleft()
+                        self.dropped += 1
+                self._queue.append(fields)
+            self._cond.notify_all()
+
+    def _get(self) -> Optional[object]:
+        with self._cond:
+            self._cond.wait_for(lambda: self._queue or self._closed)
+            if not self._queue:
+                return None
+            fields = self._queue.popleft()
+            if self._policy == LATEST:
+                fields = self._pending.pop(fields)
+            self._cond.notify_all()
+            return fields
+
+    def _work(self) -> None:
+        while True:
+            fields = self._get()
+            if fields is None:
+                return
+            for e, lock in zip(self._exporters, self._locks):
+                try:
+                    with lock:
+                        e.export(fields)
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception('%s failed to export', e)
+
+    def close(self) -> None:
+        """Exports any queued blocks and stops the workers."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+
+
+class Collector:
+    """Exports the queue depth and drop count of a pipeline.
+
+    Register with prometheus_client.REGISTRY.register().
+    """
+    def __init__(self, pipeline: Pipeline):
+        self._pipeline = pipeline
+
+    def collect(self):
+        # pylint: disable=import-outside-toplevel
+        from prometheus_client import core
+        yield core.GaugeMetricFamily(
+            'victron_queue_depth',
+            'Number of blocks waiting to be exported',
+            value=self._pipeline.depth())
+        yield core.CounterMetricFamily(
+            'victron_queue_dropped',
+            'Number of blocks dropped or coalesced by the export queue',
+            value=self._pipeline.dropped)
@@ -14,12 +14,17 @@
 """Exports fields as Prometheus gauges and enums."""
 
 import enum
-import time
+import logging
+import re
+import threading
+from typing import Dict, Optional, Set, Tuple
 
-import pint
 import prometheus_client
+import prometheus_client.core
 
+from . import block
 from . import defs
+from . import filters
 
 _UNITS = {
     '%': 'percent',
@@ -27,18 +32,13 @@ _UNITS = {
     '0.01 kWh': 'DWh',
 }
 
+_LABELS = ['serial_number', 'product_id']
 
-class Filter:
-    def __init__(self):
-        self._acc = None
-        self._tau = 0.05
+# Matches characters that are not valid in a metric name.
+_INVALID = re.compile(r'[^a-zA-Z0-9_]')
 
-    def step(self, v: float) -> float:
-        if self._acc is None:
-            self._acc = v
-
-        self._acc = self._acc * (1 - self._tau) + v * self._tau
-        return self._acc
+# The label and code of each unknown enum code that has been logged.
+_unknown = set()  # type: Set[Tuple[str, object]]
 
 
 def _is_enum(v: object) -> bool:
@@ -48,83 +48,245 @@ def _is_enum(v: object) -> bool:
         return False
 
 
+def _is_info(kind: object, value: object) -> bool:
+    """Returns True if the field should be exported as an Info."""
+    return kind == str or (kind is None and isinstance(value, str))
+
+
+def _state(label: str, value: object) -> Tuple[Optional[enum.Enum],
+                                                Optional[int]]:
+    """Returns the state and raw code of an enum field.
+
+    The state is None for a code this version does not know about,
+    which is logged once. Blocks from text.parse() hold such a code as
+    a str.
+    """
+    try:
+        code = defs.RAW_DECODERS[label](value) if isinstance(
+            value, str) else int(value)
+    except ValueError:
+        code = None
+    try:
+        return defs.ENUMS[label](value), code
+    except ValueError:
+        key = (label, value if code is None else code)
+        if key not in _unknown:
+            _unknown.add(key)
+            logging.warning('unknown %s code %s', *key)
+        return None, code
+
+
+def _name_unit(f: defs.Field) -> Tuple[str, str]:
+    """Returns the metric name and unit for a field."""
+    label = _INVALID.sub('_', f.label.replace('#', ''))
+    name = 'victron_%s' % label.lower()
+    kind = f.kind()
+    if isinstance(kind, defs.Scale):
+        unit = kind.unit
+    else:
+        unit = _UNITS.get(f.unit, f.unit)
+
+    if unit == 'hour * watt':
+        unit = 'wh'
+    return name, _INVALID.sub('_', unit)
+
+
 class Exporter:
-    def __init__(self):
-        self._metrics = None
-        self._filters = {}
-
-    def _config(self, fields):
-        metrics = {}
-        labels = ['serial_number', 'product_id']
-
-        for f in defs.FIELDS:
-            label = f.label.replace('#', '')
-            name = 'victron_%s' % label.lower()
-            kind = f.kind()
-            if isinstance(kind, pint.Quantity):
-                unit = str(kind.units)
-            else:
-                unit = _UNITS.get(f.unit, f.unit)
-
-            if unit == 'hour * watt':
-                unit = 'wh'
-
-            if kind == str:
-                metrics[f.label] = prometheus_client.Info(name,
-                                                          f.description,
-                                                          labelnames=labels)
-            elif _is_enum(kind):
-                states = [x.name.lower() for x in kind]
-                metrics[f.label] = prometheus_client.Enum(
-                    name,
-                    f.description,
-                    labelnames=['serial_number', 'product_id'],
-                    states=states)
-                metrics[f.label + '_value'] = prometheus_client.Gauge(
-                    name + '_value',
-                    f.description,
-                    labelnames=['serial_number', 'product_id'])
-            else:
-                metrics[f.label] = prometheus_client.Gauge(
-                    name,
-                    f.description,
-                    labelnames=['serial_number', 'product_id'],
-                    unit=unit)
+    """Exporter updates Prometheus metrics on every block.
+
+    The metrics for a field are created the first time it is seen.
+    Quantities are smoothed by bank over the time between the arrival
+    of blocks, so blocks that were queued are filtered correctly.
+    """
+    def __init__(self,
+                 registry=prometheus_client.REGISTRY,
+                 bank: Optional[filters.FilterBank] = None):
+        self._registry = registry
+        self._metrics = {}
+        self._updated = None
+        self._blocks = None
+        self._filters = bank or filters.FilterBank()
 
+    def _config(self):
         updated = prometheus_client.Gauge(
             'victron_updated',
             'Last time a block was received from the device',
-            labelnames=labels)
+            labelnames=_LABELS,
+            registry=self._registry)
         blocks = prometheus_client.Counter(
             'victron_blocks',
             'Number of blocks received from the device',
-            labelnames=labels)
+            labelnames=_LABELS,
+            registry=self._registry)
 
-        return metrics, updated, blocks
+        return updated, blocks
+
+    def _create(self, f: defs.Field, value: object) -> None:
+        """Creates the metrics for a newly seen field."""
+        name, unit = _name_unit(f)
+        kind = f.kind()
+
+        if _is_info(kind, value):
+            self._metrics[f.label] = prometheus_client.Info(
+                name,
+                f.description,
+                labelnames=_LABELS,
+                registry=self._registry)
+        elif _is_enum(kind):
+            states = [x.name.lower() for x in kind]
+            self._metrics[f.label] = prometheus_client.Enum(
+                name,
+                f.description,
+                labelnames=_LABELS,
+                states=states,
+                registry=self._registry)
+            self._metrics[f.label + '_value'] = prometheus_client.Gauge(
+                name + '_value',
+                f.description,
+                labelnames=_LABELS,
+                registry=self._registry)
+        else:
+            self._metrics[f.label] = prometheus_client.Gauge(
+                name,
+                f.description,
+                labelnames=_LABELS,
+                unit=unit,
+                registry=self._registry)
 
     def export(self, fields):
-        if self._metrics is None:
-            self._metrics, self._updated, self._blocks = self._config(fields)
+        if self._updated is None:
+            self._updated, self._blocks = self._config()
 
         ser = fields[defs.SER.label]
         pid = fields[defs.PID.label]
-        self._updated.labels(ser, pid).set(time.time())
+        now = block.arrival(fields)
+        self._updated.labels(ser, pid).set(now)
         self._blocks.labels(ser, pid).inc()
 
-        for label, value in fields.items():
-            gauge = self._metrics[label]
-            if isinstance(value, pint.Quantity):
-                f = self._filters.setdefault(label, Filter())
-                m = f.step(value.m)
-                gauge.labels(ser, pid).set(round(m, 3))
-            elif isinstance(gauge, prometheus_client.Info):
-                gauge.labels(ser,
-                             pid).info({label.lower().replace('#', ''): value})
+        for label, value in block.plain(fields):
+            gauge = self._metrics.get(label)
+            if gauge is None:
+                self._create(defs.lookup(label), value)
+                gauge = self._metrics[label]
+
+            if isinstance(gauge, prometheus_client.Info):
+                gauge.labels(ser, pid).info(
+                    {label.lower().replace('#', ''): str(value)})
             elif isinstance(gauge, prometheus_client.Enum):
-                gauge.labels(ser, pid).state(value.name.lower())
-                self._metrics[label + '_value'].labels(ser,
-                                                       pid).set(value.value)
+                state, code = _state(label, value)
+                if state is not None:
+                    gauge.labels(ser, pid).state(state.name.lower())
+                if code is not None:
+                    self._metrics[label + '_value'].labels(ser,
+                                                           pid).set(code)
+            elif label in defs.SCALES and not isinstance(value, str):
+                m = self._filters.step(ser, label, value, now)
+                gauge.labels(ser, pid).set(round(m, 3))
             elif isinstance(value, int):
                 gauge.labels(ser, pid).set(value)
             else:
                 print(repr(value))
+
+
+class Collector:
+    """Collector exports the latest block of each device when scraped.
+
+    export() only records the block, so the per-block cost is
+    independent of the number of fields. Quantities are smoothed by
+    bank when scraped, stepping the filters once per scrape with the
+    latest block and its arrival time. Blocks between scrapes are not
+    filtered, so the averages differ from those of Exporter, which
+    steps the filters for every block. Register with
+    prometheus_client.REGISTRY.register().
+    """
+    def __init__(self, bank: Optional[filters.FilterBank] = None):
+        # Maps the serial number to the latest block, the time it was
+        # received, and the number of blocks received.
+        self._latest = {}  # type: Dict[str, Tuple[object, float, int]]
+        self._filters = bank or filters.FilterBank()
+        # Maps the serial number to the time of the block last stepped
+        # through the filters and the outputs.
+        self._smoothed = {}  # type: Dict[str, Tuple[float, dict]]
+        self._lock = threading.Lock()
+
+    def export(self, fields) -> None:
+        ser = fields[defs.SER.label]
+        last = self._latest.get(ser)
+        self._latest[ser] = (fields, block.arrival(fields),
+                             last[2] + 1 if last else 1)
+
+    def collect(self):
+        families = {}  # type: Dict[str, prometheus_client.core.Metric]
+        updated = prometheus_client.core.GaugeMetricFamily(
+            'victron_updated',
+            'Last time a block was received from the device',
+            labels=_LABELS)
+        blocks = prometheus_client.core.CounterMetricFamily(
+            'victron_blocks',
+            'Number of blocks received from the device',
+            labels=_LABELS)
+
+        for fields, received, count in list(self._latest.values()):
+            ser = fields[defs.SER.label]
+            pid = fields.get(defs.PID.label, '')
+            updated.add_metric([ser, pid], received)
+            blocks.add_metric([ser, pid], count)
+
+            smoothed = self._smooth(ser, fields, received)
+            for label, value in block.plain(fields):
+                self._add(families, defs.lookup(label), [ser, pid],
+                          smoothed.get(label, value))
+
+        yield from families.values()
+        yield updated
+        yield blocks
+
+    def _smooth(self, ser: str, fields, received: float) -> dict:
+        """Steps the filters with a block unless already done and
+        returns the smoothed quantities."""
+        with self._lock:
+            last = self._smoothed.get(ser)
+            if last is not None and last[0] == received:
+                return last[1]
+            out = {
+                label: self._filters.step(ser, label, value, received)
+                for label, value in block.plain(fields)
+                if label in defs.SCALES and not isinstance(value, str)
+            }
+            self._smoothed[ser] = (received, out)
+            return out
+
+    def _add(self, families: dict, f: defs.Field, values: list,
+             value: object) -> None:
+        name, unit = _name_unit(f)
+        kind = f.kind()
+        core = prometheus_client.core
+
+        if _is_info(kind, value):
+            family = families.get(name)
+            if family is None:
+                family = families[name] = core.InfoMetricFamily(
+                    name, f.description, labels=_LABELS)
+            family.add_metric(
+                values, {f.label.lower().replace('#', ''): str(value)})
+        elif _is_enum(kind):
+            family = families.get(name)
+            if family is None:
+                family = families[name] = core.StateSetMetricFamily(
+                    name, f.description, labels=_LABELS)
+                families[name + '_value'] = core.GaugeMetricFamily(
+                    name + '_value', f.description, labels=_LABELS)
+            state, code = _state(f.label, value)
+            if state is not None:
+                family.add_metric(values, {
+                    x.name.lower(): x == state
+                    for x in kind
+                })
+            if code is not None:
+                families[name + '_value'].add_metric(values, code)
+        elif isinstance(value, (int, float)):
+            family = families.get(name)
+            if family is None:
+                family = families[name] = core.GaugeMetricFamily(
+                    name, f.description, labels=_LABELS, unit=unit)
+            family.add_metric(values, round(value, 3))
@@ -0,0 +1,144 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Spreads many ports over worker processes.
+
+Each worker reads a shard of the ports on its own event loop and sends
+compact blocks to the parent over a queue. The parent passes them to
+the exporters, so there is still one Prometheus endpoint and one MQTT
+connection.
+"""
+
+import logging
+import multiprocessing
+import queue
+from typing import Dict, List, Optional, Sequence
+
+from . import aio
+
+# Most blocks exported per pump() so that workers are still checked
+# under load.
+_MAX_PUMP = 1000
+
+
+class _Sender:
+    """Sends each block to the parent."""
+    def __init__(self, q: multiprocessing.Queue):
+        self._q = q
+
+    def export(self, fields) -> None:
+        self._q.put(fields)
+
+
+def _work(ports: Sequence[str], q: multiprocessing.Queue, validate: bool,
+          capture_path: Optional[str], stale: float,
+          polls: Optional[Dict[int, float]]) -> None:
+    aio.run(ports, [_Sender(q)],
+            validate,
+            compact=True,
+            capture_path=capture_path,
+            stale=stale,
+            polls=polls)
+
+
+class Shards:
+    """Shards runs worker processes that each read a share of the ports.
+
+    Call pump() repeatedly to export the blocks the workers have read.
+    Workers that exit are restarted.
+    """
+    def __init__(self,
+                 ports: Sequence[str],
+                 workers: int,
+                 validate: bool = False,
+                 capture_path: Optional[str] = None,
+                 stale: float = aio.STALE_TIMEOUT,
+                 polls: Optional[Dict[int, float]] = None):
+        # Spawned workers do not inherit the parent's exporter threads
+        # and sockets.
+        self._ctx = multiprocessing.get_context('spawn')
+        self._q = self._ctx.Queue()
+        self._args = []  # type: List[tuple]
+        for i in range(min(workers, len(ports))):
+            shard = ports[i::workers]
+            path = capture_path
+            if len(shard) == 1:
+                # A worker with one port would not add its name.
+                path = aio.capture_path(capture_path, ports, shard[0])
+            self._args.append(
+                (shard, self._q, validate, path, stale, polls))
+        self._procs = [None] * len(self._args)  # type: List
+        self.restarts = 0
+
+    def _start(self, i: int) -> None:
+        p = self._ctx.Process(target=_work,
+                              args=self._args[i],
+                              name='vedirect-shard-%d' % i,
+                              daemon=True)
+        p.start()
+        self._procs[i] = p
+
+    def start(self) -> None:
+        for i in range(len(self._args)):
+            self._start(i)
+
+    def pump(self, exporters: Sequence, timeout: float = 1.0) -> int:
+        """Exports the blocks read by the workers.
+
+        Waits up to timeout for the first block. Returns the number of
+        blocks exported.
+        """
+        for i, p in enumerate(self._procs):
+            if not p.is_alive():
+                logging.warning('%s exited with %s; restarting', p.name,
+                                p.exitcode)
+                self.restarts += 1
+                self._start(i)
+
+        count = 0
+        try:
+            fields = self._q.get(timeout=timeout)
+            while True:
+                for e in exporters:
+                    e.export(fields)
+                count += 1
+                if count == _MAX_PUMP:
+                    break
+                fields = self._q.get_nowait()
+        except queue.Empty:
+            pass
+        return count
+
+    def close(self) -> None:
+        for p in self._procs:
+            p.terminate()
+        for p in self._procs:
+            p.join()
+
+
+def run(ports: Sequence[str],
+        exporters: Sequence,
+        workers: int,
+        validate: bool = False,
+        capture_path: Optional[str] = None,
+        stale: float = aio.STALE_TIMEOUT,
+        polls: Optional[Dict[int, float]] = None) -> None:
+    """Reads the ports in worker processes and passes every block to
+    each exporter. Runs forever."""
+    shards = Shards(ports, workers, validate, capture_path, stale, polls)
+    shards.start()
+    try:
+        while True:
+            shards.pump(exporters)
+    finally:
+        shards.close()
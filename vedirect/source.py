@@ -0,0 +1,108 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Sources of VE.Direct data: local serial ports and network bridges."""
+
+import os
+import random
+import select
+from typing import Optional, Tuple
+import urllib.parse
+
+import serial
+
+# URL schemes of network sources.
+TCP = 'tcp'
+RFC2217 = 'rfc2217'
+SCHEMES = (TCP, RFC2217)
+
+
+def is_url(port: str) -> bool:
+    """Returns True if port names a network source rather than a path."""
+    return urllib.parse.urlsplit(port).scheme in SCHEMES
+
+
+def address(url: str) -> Tuple[str, int]:
+    """Returns the host and TCP port of a network source URL."""
+    parts = urllib.parse.urlsplit(url)
+    if not parts.hostname or not parts.port:
+        raise ValueError('%s needs a host and port' % url)
+    return parts.hostname, parts.port
+
+
+class Backoff:
+    """Backoff gives exponentially increasing delays between reconnects.
+
+    Delays start at initial and double up to maximum with up to 10%
+    jitter so that many sources behind one bridge do not reconnect in
+    lockstep.
+    """
+    def __init__(self, initial: float = 1.0, maximum: float = 60.0):
+        self._initial = initial
+        self._maximum = maximum
+        self._delay = initial
+
+    def reset(self) -> None:
+        self._delay = self._initial
+
+    def next(self) -> float:
+        """Returns the delay before the next attempt."""
+        delay = self._delay
+        self._delay = min(self._delay * 2, self._maximum)
+        return delay * random.uniform(0.9, 1.0)
+
+
+class SerialSource:
+    """SerialSource reads a serial port without polling.
+
+    wait() blocks until the port is readable and readinto() never
+    blocks, so the fd may also be watched by a selector or event loop.
+    """
+    def __init__(self, port: str, baudrate: int = 19200):
+        self.name = port
+        # A zero timeout makes the port non-blocking.
+        self._serial = serial.Serial(port, baudrate, timeout=0)
+        self._fd = self._serial.fileno()
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Waits until the port is readable. Returns False on timeout."""
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        return bool(ready)
+
+    def readinto(self, view: memoryview) -> int:
+        """Reads whatever is buffered into view and returns the length."""
+        try:
+            got = os.readv(self._fd, [view])
+        except BlockingIOError:
+            return 0
+        if not got and self.wait(0):
+            # Readable with no data means the device has gone away.
+            raise serial.SerialException(
+                '%s reports readiness to read but returned no data' %
+                self.name)
+        return got
+
+    def read(self, size: int) -> bytes:
+        """Blocks until data is available and returns up to size bytes."""
+        self.wait()
+        buf = bytearray(size)
+        return bytes(buf[:self.readinto(memoryview(buf))])
+
+    def write(self, data: bytes) -> None:
+        self._serial.write(data)
+
+    def close(self) -> None:
+        self._serial.close()
@@ -0,0 +1,69 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from unittest import mock
+
+import prometheus_client
+
+from . import aggregate
+from . import block
+
+
+def _block(ser, ppv, i):
+    return block.Block({'SER#': ser, 'PID': '0xA042', 'PPV': ppv, 'I': i},
+                       1000.0)
+
+
+@mock.patch('time.monotonic')
+def test_totals(monotonic, collect):
+    monotonic.return_value = 0
+    sink = collect
+    a = aggregate.Aggregator(groups={'shed': ['HQ2', 'HQ3']},
+                             stale=60,
+                             sinks=[sink])
+    a.export(_block('HQ1', 100, 1.5))
+    a.export(_block('HQ2', 50, -0.5))
+    a.export(_block('HQ1', 120, 2.0))
+
+    assert a.groups() == ['fleet', 'shed']
+    fleet = a.total('fleet')
+    assert (fleet['PPV'], fleet['I'], fleet['N']) == (170, 1.5, 2)
+    assert a.total('shed')['PPV'] == 50
+    assert sink.blocks[-1]['SER#'] == 'total_fleet'
+    assert sink.blocks[-1]['PPV'] == 170
+    assert sink.blocks[-1].time == 1000.0
+
+    # HQ2 drops out and its contribution is removed.
+    monotonic.return_value = 45
+    a.export(_block('HQ1', 130, 2.0))
+    monotonic.return_value = 70
+    a.export(_block('HQ1', 140, 2.0))
+    assert a.total('fleet')['PPV'] == 140
+    assert a.devices('fleet') == 1
+    assert a.total('shed')['PPV'] == 0
+    assert a.devices('shed') == 0
+    assert sink.blocks[-1]['SER#'] == 'total_shed'
+
+
+def test_collector():
+    a = aggregate.Aggregator()
+    a.export(_block('HQ1', 100, 1.5))
+    a.export(_block('HQ2', 50, -0.5))
+    registry = prometheus_client.CollectorRegistry()
+    registry.register(aggregate.Collector(a))
+    assert registry.get_sample_value('victron_total_ppv_watt',
+                                     {'group': 'fleet'}) == 150
+    assert registry.get_sample_value('victron_total_i_ampere',
+                                     {'group': 'fleet'}) == 1.0
+    assert registry.get_sample_value('victron_total_devices',
+                                     {'group': 'fleet'}) == 2
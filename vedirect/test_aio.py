@@ -0,0 +1,147 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+
+from . import aio
+from . import source
+from . import test_text
+
+
+class _Collect:
+    def __init__(self, want: int):
+        self.blocks = []
+        self.done = asyncio.Event()
+        self._want = want
+
+    def export(self, fields):
+        self.blocks.append(fields)
+        if len(self.blocks) == self._want:
+            self.done.set()
+
+
+async def _serve_and_read(first: bytes, stale: float = 30):
+    data = (test_text._SYNC + test_text._BLOCK).replace(b'\n', b'\r\n')
+    connects = []
+
+    async def handle(reader, writer):
+        connects.append(1)
+        if len(connects) == 1:
+            writer.write(first)
+            await writer.drain()
+            if stale:
+                # Hold the connection open without sending a block.
+                await reader.read()
+        else:
+            writer.write(data * 2)
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    out = _Collect(1)
+    r = aio._reader('tcp://127.0.0.1:%d' % port, [out], False, False, None,
+                    None, stale)
+    r._backoff = source.Backoff(0.01, 0.01)
+    task = asyncio.ensure_future(r.run())
+    await asyncio.wait_for(out.done.wait(), 5)
+    task.cancel()
+    server.close()
+    return out.blocks, len(connects)
+
+
+def test_tcp_reconnect():
+    # A partial block is dropped when the connection closes.
+    data = (test_text._SYNC + test_text._BLOCK).replace(b'\n', b'\r\n')
+    blocks, connects = asyncio.run(_serve_and_read(data[:-10], stale=0))
+    assert connects == 2
+    assert blocks[0]['SER#'] == 'HQ1949I8BGA'
+
+
+def test_stale_reopen():
+    blocks, connects = asyncio.run(_serve_and_read(b'V\t12', stale=0.1))
+    assert connects == 2
+    assert blocks[0]['SER#'] == 'HQ1949I8BGA'
+
+
+def test_many_ports():
+    data = (test_text._SYNC + test_text._BLOCK).replace(b'\n', b'\r\n')
+
+    async def run():
+        ports = []
+        servers = []
+        for ser in (b'HQ1', b'HQ2'):
+
+            async def handle(reader, writer, ser=ser):
+                writer.write(data.replace(b'HQ1949I8BGA', ser))
+                await writer.drain()
+                await reader.read()
+                writer.close()
+
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            servers.append(server)
+            ports.append('tcp://127.0.0.1:%d' %
+                         server.sockets[0].getsockname()[1])
+        out = _Collect(2)
+        task = asyncio.ensure_future(
+            aio._run(ports, [out], False, True, None, None, 0, None))
+        await asyncio.wait_for(out.done.wait(), 5)
+        task.cancel()
+        for server in servers:
+            server.close()
+        return out.blocks
+
+    blocks = asyncio.run(run())
+    assert sorted(x['SER#'] for x in blocks) == ['HQ1', 'HQ2']
+
+
+def test_tcp_resync():
+    # A framing error resyncs the parser instead of ending the reader.
+    good = test_text._BLOCK.replace(b'\n', b'\r\n')
+    bad = good.replace(b'VPV\t13590\r\n', b'VPV\t13590\r')
+    first = test_text._SYNC.replace(b'\n', b'\r\n') + good + bad + good
+
+    async def run():
+        async def handle(_, writer):
+            writer.write(first + good)
+            await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        out = _Collect(2)
+        r = aio._reader('tcp://127.0.0.1:%d' % port, [out], False, False,
+                        None, None, 0)
+        task = asyncio.ensure_future(r.run())
+        await asyncio.wait_for(out.done.wait(), 5)
+        assert not task.done()
+        task.cancel()
+        server.close()
+        return out.blocks
+
+    blocks = asyncio.run(run())
+    assert all(x['SER#'] == 'HQ1949I8BGA' for x in blocks)
+
+
+def test_address():
+    assert source.is_url('tcp://shed:4001')
+    assert source.is_url('rfc2217://shed:4002')
+    assert not source.is_url('/dev/serial/by-id/usb-VictronEnergy')
+    assert source.address('tcp://shed:4001') == ('shed', 4001)
+
+
+def test_capture_path():
+    ports = ['/dev/ttyUSB0', 'tcp://shed:4001']
+    assert aio.capture_path('cap', ports[:1], ports[0]) == 'cap'
+    assert aio.capture_path('cap', ports, ports[0]) == 'cap.ttyUSB0'
+    assert aio.capture_path(None, ports, ports[0]) is None
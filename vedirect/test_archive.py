@@ -0,0 +1,105 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import math
+import os
+
+import pytest
+
+from . import archive
+from . import bench
+from . import block
+from . import text
+
+
+def test_archive_roundtrip(tmp_path):
+    stream = bench.generate('mppt', 250, devices=2)
+    blocks = []
+    for s in stream:
+        blocks.extend(text.Parser(compact=True).feed(s))
+    for i, b in enumerate(blocks):
+        b.time = 1600000000 + i % 250 + 0.25
+
+    out = archive.Exporter(str(tmp_path), chunk=100, rotate_bytes=1000)
+    for b in blocks:
+        out.export(b)
+    out.close()
+    paths = archive.files(str(tmp_path))
+    assert len(paths) > 1
+
+    times, values = archive.load(paths, 'HQ0001BENCH', ['V', 'CS', 'XX'])
+    want = blocks[250:]
+    assert list(times) == [b.time for b in want]
+    assert list(values['V']) == [b['V'] for b in want]
+    assert list(values['CS']) == [b['CS'] for b in want]
+    assert all(math.isnan(x) for x in values['XX'])
+
+    times, values = archive.load(paths, 'HQ0000BENCH', ['V'],
+                                 since=1600000100, until=1600000110)
+    assert list(times) == [b.time for b in blocks[100:110]]
+
+
+def test_archive_torn(tmp_path):
+    stream = bench.generate('mppt', 50)
+    blocks = []
+    for s in stream:
+        blocks.extend(text.Parser(compact=True).feed(s))
+    out = archive.Exporter(str(tmp_path / 'in'), chunk=10)
+    for b in blocks:
+        out.export(b)
+    out.close()
+    path, = archive.files(str(tmp_path / 'in'))
+    with open(path, 'rb') as f:
+        data = f.read()
+    whole = list(archive.load([path], 'HQ0000BENCH', ['V'])[0])
+    torn = str(tmp_path / 'torn.vda')
+    for cut in (1, 30, 100, 500):
+        with open(torn, 'wb') as f:
+            f.write(data[:-cut])
+        times = list(archive.load([torn], 'HQ0000BENCH', ['V'])[0])
+        # Only the torn chunk and those after it are lost.
+        assert times == whole[:len(times)]
+        assert len(times) >= len(whole) - 10 * (1 + cut // 50)
+    assert len(archive.load([torn], 'HQ0000BENCH', ['V'])[0]) < 50
+
+
+def test_archive_fractions(tmp_path):
+    out = archive.Exporter(str(tmp_path))
+    # PB is derived and PPV merged from a HEX register, so both have
+    # fractions that the TEXT scale of a watt would lose.
+    values = [(12.34, 0.25), (12.35, 1.5), (12.345, 0.0), (12.0, 3.0)]
+    for i, (ppv, pb) in enumerate(values):
+        out.export(
+            block.Block({
+                'SER#': 'HQ1',
+                'PPV': ppv,
+                'PB': pb,
+                'H21': 7
+            }, 1600000000 + i))
+    # Integers of a field in whole units keep its scale.
+    out.export(block.Block({'SER#': 'HQ1', 'PPV': 12, 'PB': 3.0,
+                            'H21': 7}, 1600000010))
+    out.close()
+    _, got = archive.load(archive.files(str(tmp_path)), 'HQ1',
+                          ['PPV', 'PB', 'H21'])
+    want = values + [(12, 3.0)]
+    assert list(got['PPV']) == pytest.approx([x for x, _ in want])
+    assert list(got['PB']) == pytest.approx([x for _, x in want])
+    assert list(got['H21']) == [7] * 5
+
+
+def test_varint():
+    data = bytearray()
+    values = [0, 1, -1, 300, -70000, 2**40, 5]
+    archive._encode(values, data)
+    assert list(archive._decode(bytes(data), len(values))) == values
@@ -0,0 +1,36 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from . import bench
+from . import text
+
+
+def test_generate():
+    for profile, fields in bench.PROFILES.items():
+        streams = bench.generate(profile, 50, devices=2)
+        assert len(streams) == 2
+        parser = text.Parser(validate=True)
+        blocks = parser.feed(streams[1])
+        assert len(blocks) == 50
+        assert list(blocks[0]) == [x.label for x in fields]
+        assert blocks[0]['SER#'] == 'HQ0001BENCH'
+
+
+def test_generate_corrupt():
+    stream = bench.generate('mppt', 200, corruption=0.2)[0]
+    parser = text.Parser(validate=True)
+    parser.feed(stream)
+    stats = parser.stats
+    assert 100 < stats.valid < 200
+    assert stats.valid + stats.bad_checksum + stats.framing_errors <= 200
@@ -0,0 +1,73 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import itertools
+
+import pytest
+
+from . import capture
+from . import cli
+from . import test_text
+from . import text
+
+
+def test_capture_and_replay(tmp_path):
+    path = str(tmp_path / 'capture.bin')
+    data = (test_text._SYNC + test_text._BLOCK * 3).replace(b'\n', b'\r\n')
+
+    src = capture.Tee(io.BytesIO(data), capture.Writer(path))
+    assert len(list(itertools.islice(text.parse(src), 3))) == 3
+
+    replay = capture.Replay(path, speed=0)
+    blocks = []
+    with pytest.raises(EOFError):
+        for fields in text.parse(replay):
+            blocks.append(fields)
+    assert len(blocks) == 3
+    assert blocks[0]['SER#'] == 'HQ1949I8BGA'
+
+
+def test_replay_keeps_timing(tmp_path, monkeypatch):
+    path = str(tmp_path / 'capture.bin')
+    w = capture.Writer(path)
+    w.write(b'a', 100.0)
+    w.write(b'bc', 104.0)
+    w.close()
+
+    sleeps = []
+    monkeypatch.setattr('time.monotonic', lambda: 0)
+    monkeypatch.setattr('time.sleep', sleeps.append)
+    replay = capture.Replay(path, speed=2)
+    assert replay.read(10) == b'a'
+    assert replay.read(1) == b'b'
+    assert replay.read(1) == b'c'
+    assert sleeps == [2.0]
+
+
+def test_replay_arrival_times(tmp_path, collect):
+    path = str(tmp_path / 'capture.bin')
+    good = test_text._BLOCK.replace(b'\n', b'\r\n')
+    bad = good.replace(b'VPV\t13590\r\n', b'VPV\t13590\r')
+    w = capture.Writer(path)
+    w.write(test_text._SYNC.replace(b'\n', b'\r\n'), 100.0)
+    for i, data in enumerate([good, bad, good, good]):
+        w.write(data, 101.0 + i)
+    w.close()
+
+    replay = capture.Replay(path, speed=0)
+    with pytest.raises(EOFError):
+        # A framing error resyncs instead of ending the replay.
+        cli._replay(replay, [collect], False, True, None, path)
+    assert [x.time for x in collect.blocks] == [100.0, 103.0, 103.0]
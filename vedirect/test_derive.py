@@ -0,0 +1,61 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import pytest
+
+from . import block
+from . import derive
+from . import test_text
+from . import text
+from . import units
+
+
+def _block(t, ppv=100):
+    return block.Block({
+        'SER#': 'HQ1',
+        'V': 12.5,
+        'I': -2.0,
+        'PPV': ppv
+    }, t)
+
+
+def test_derive(tmp_path, collect):
+    state = str(tmp_path / 'derive.json')
+    out = collect
+    d = derive.Deriver([out], state)
+    for t in range(3601):
+        d.export(_block(1000.0 + t))
+    got = out.blocks[-1]
+    assert got['PB'] == -25.0
+    assert got['EPV'] == pytest.approx(100.0, abs=1e-9)
+    assert got['EB'] == pytest.approx(-25.0, abs=1e-9)
+    assert got.unit('EPV') == 'hour * watt'
+    d.close()
+
+    # The integrals carry on after a restart, without integrating
+    # across the gap.
+    d = derive.Deriver([out], state)
+    d.export(_block(9000.0, ppv=0))
+    d.export(_block(9036.0, ppv=0))
+    assert out.blocks[-1]['EPV'] == pytest.approx(100.0, abs=1e-9)
+    d.export(_block(9072.0, ppv=200))
+    assert out.blocks[-1]['EPV'] == pytest.approx(101.0, abs=1e-9)
+
+
+def test_derive_quantities():
+    data = (test_text._SYNC + test_text._BLOCK).replace(b'\n', b'\r\n')
+    fields = text.Parser().feed(data)[0]
+    got = derive.Deriver([]).derive(fields)
+    ureg = units.registry()
+    assert got['PB'] == 0 * ureg.watt
+    assert got['V'] == fields['V']
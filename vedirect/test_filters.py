@@ -0,0 +1,40 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+
+import pytest
+
+from . import filters
+
+
+def test_ema_uses_time():
+    bank = filters.FilterBank(tau=10)
+    assert bank.step('a', 'V', 0, 0) == 0
+    assert bank.step('a', 'V', 1, 10) == pytest.approx(1 - math.exp(-1))
+    # Devices are filtered separately.
+    assert bank.step('b', 'V', 5, 10) == 5
+
+
+def test_mean():
+    bank = filters.FilterBank(kinds={'V': filters.MEAN}, window=3)
+    got = [bank.step('a', 'V', v, t) for t, v in enumerate([3, 6, 9, 12, 0])]
+    assert got == [3, 4.5, 6, 9, 7]
+
+
+def test_max_hold():
+    bank = filters.FilterBank(tau=10, kinds={'PPV': filters.MAX})
+    got = [bank.step('a', 'PPV', v, t) for t, v in [(0, 5), (5, 9), (9, 1),
+                                                    (10, 2), (12, 1)]]
+    assert got == [5, 9, 9, 2, 2]
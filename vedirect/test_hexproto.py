@@ -0,0 +1,142 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import struct
+
+import pytest
+
+from . import hexproto
+from . import test_text
+from . import text
+
+_BLOCK = test_text._BLOCK.replace(b'\n', b'\r\n')
+_TEXT = test_text._SYNC.replace(b'\n', b'\r\n') + _BLOCK
+
+
+class _Device:
+    """Simulates a charger that answers GET frames between TEXT lines."""
+    def __init__(self, registers):
+        self.registers = registers
+        self.requests = []
+        self._replies = []
+        self._synced = False
+
+    def write(self, data: bytes) -> None:
+        assert data.startswith(b':') and data.endswith(b'\n')
+        frame = hexproto.decode(data[1:-1])
+        self.requests.append(frame)
+        register, _, _ = hexproto.parse_register(frame)
+        if register in self.registers:
+            fmt, value = self.registers[register]
+            reply = hexproto.encode(
+                hexproto.GET,
+                struct.pack('<HB', register, 0) + struct.pack(fmt, value))
+        else:
+            reply = hexproto.encode(
+                hexproto.GET,
+                struct.pack('<HB', register, hexproto.FLAG_UNKNOWN_ID))
+        self._replies.append(reply)
+
+    def read(self) -> bytes:
+        """Returns a TEXT block with the pending replies after its
+        first line."""
+        data = _BLOCK if self._synced else _TEXT
+        self._synced = True
+        i = data.index(b'\r\n') + 2
+        data = data[:i] + b''.join(self._replies) + data[i:]
+        self._replies = []
+        return data
+
+
+def test_encode_decode():
+    # The example from the protocol documentation.
+    assert hexproto.get(0xEDF0) == b':7F0ED0071\n'
+    frame = hexproto.decode(b'7F0ED0071')
+    assert frame == hexproto.Frame(hexproto.GET, b'\xf0\xed\x00')
+    assert hexproto.parse_register(frame) == (0xEDF0, 0, b'')
+    with pytest.raises(ValueError):
+        hexproto.decode(b'7F0ED0072')
+
+
+def test_demux():
+    demux = hexproto.Demux()
+    value = b'\xd5\xed\x00\xba\x04'
+    frame = hexproto.encode(hexproto.ASYNC, value)
+    # A TEXT checksum byte may be a ':'.
+    data = b'V\t1\r\nChecksum\t:' + frame + b'\r\nPID\t0xA042\r\n'
+    got_text = b''
+    got_frames = []
+    for i in range(0, len(data), 5):
+        t, frames = demux.feed(data[i:i + 5])
+        got_text += t
+        got_frames += frames
+    assert got_text == b'V\t1\r\nChecksum\t:\r\nPID\t0xA042\r\n'
+    assert got_frames == [hexproto.Frame(hexproto.ASYNC, value)]
+    assert demux.errors == 0
+
+    t, frames = demux.feed(b':7F0ED0072\nV\t1\r\n')
+    assert (t, frames, demux.errors) == (b'V\t1\r\n', [], 1)
+
+
+def test_session():
+    device = _Device({0xEDD5: ('<H', 1234), 0xEDBC: ('<I', 5678)})
+    parser = text.Parser(validate=True, compact=True)
+    session = hexproto.Session(parser.feed, device.write, {
+        0xEDD5: 1,
+        0xEDBC: 5,
+        # Not known to the device.
+        0xEDBB: 5,
+    })
+
+    assert session.poll(0.0) == 1.0
+    assert len(device.requests) == 3
+    blocks = session.feed(device.read(), 0.1)
+    # The TEXT checksum still holds with the replies removed.
+    assert parser.stats.valid == 1
+    assert blocks[0]['V'] == pytest.approx(12.34)
+    assert blocks[0]['PPV'] == pytest.approx(56.78)
+    assert blocks[0]['VPV'] == 13.59
+
+    # Only V is due again after a second.
+    session.poll(1.0)
+    assert len(device.requests) == 4
+    blocks = session.feed(device.read(), 1.1)
+    assert blocks[0]['V'] == pytest.approx(12.34)
+    # Replies from before the previous block do not hide TEXT values.
+    assert blocks[0]['PPV'] == 0
+    blocks = session.feed(device.read(), 2.1)
+    assert blocks[0]['V'] == 12.11
+
+    # Values expire when they are no longer polled.
+    blocks = session.feed(device.read(), 30.0)
+    assert blocks[0]['V'] == 12.11
+    assert blocks[0]['PPV'] == 0
+
+
+def test_scheduler_budget():
+    rates = {r.id: 0.01 for r in hexproto.REGISTERS}
+    s = hexproto.Scheduler(rates, budget=0.1)
+    sent = 0
+    for i in range(1000):
+        sent += sum(len(x) for x in s.due(i * 0.01))
+    # Requests are under half of the budget of 192 bytes/s over 10 s.
+    assert 0 < sent <= 192 * 10 / 2
+
+
+def test_parse_rates():
+    assert hexproto.parse_rates(['V=0.5', 'EDBC=30']) == {
+        0xEDD5: 0.5,
+        0xEDBC: 30.0
+    }
+    with pytest.raises(ValueError):
+        hexproto.parse_rates(['EDF0=1'])
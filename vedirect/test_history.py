@@ -0,0 +1,77 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import urllib.request
+
+import pytest
+
+from . import block
+from . import history
+
+
+def _feed(h, times, label='VPV'):
+    for t in times:
+        h.export(block.Block({'SER#': 'HQ1', label: t % 7, 'FW': '1.53'}, t))
+
+
+def test_raw_ring():
+    h = history.History(samples=10)
+    _feed(h, range(100, 130))
+    got = h.query('HQ1', 'VPV', 0)
+    # Only the newest samples are kept.
+    assert [x['time'] for x in got] == list(range(120, 130))
+    got = h.query('HQ1', 'VPV', 123, 126)
+    assert got == [{'time': t, 'value': t % 7} for t in range(123, 126)]
+    assert h.query('HQ1', 'FW', 0) is None
+    assert h.query('HQ2', 'VPV', 0) is None
+    assert h.series() == [('HQ1', 'VPV')]
+
+
+def test_rollups():
+    # A block time of 0 means unknown, so start at a time aligned to
+    # the rollups and to the values, which repeat every 7 s.
+    base = 900 * 7 * 10**5
+    h = history.History(samples=10, rollups=((60, 3), (900, 2)))
+    _feed(h, range(base, base + 300, 10))
+    got = h.query('HQ1', 'VPV', 0, period=60)
+    # Three closed minutes and the open one.
+    assert [x['time'] - base for x in got] == [60, 120, 180, 240]
+    values = [t % 7 for t in range(60, 120, 10)]
+    assert got[0] == {
+        'time': base + 60,
+        'min': min(values),
+        'max': max(values),
+        'mean': sum(values) / len(values),
+    }
+    got = h.query('HQ1', 'VPV', 0, period=900)
+    assert len(got) == 1
+    assert got[0]['mean'] == pytest.approx(
+        sum(t % 7 for t in range(0, 300, 10)) / 30)
+    with pytest.raises(ValueError):
+        h.query('HQ1', 'VPV', 0, period=30)
+    assert h.bytes_per_series() == 8 * (2 * 10 + 5 * (4 + 3))
+
+
+def test_serve():
+    h = history.History()
+    _feed(h, range(100, 110))
+    server = history.serve(h, 0, '127.0.0.1')
+    try:
+        base = 'http://127.0.0.1:%d/history' % server.server_address[1]
+        with urllib.request.urlopen(base) as r:
+            assert json.load(r) == [{'serial_number': 'HQ1', 'field': 'VPV'}]
+        with urllib.request.urlopen(base + '/HQ1/VPV?since=105') as r:
+            assert len(json.load(r)) == 5
+    finally:
+        server.shutdown()
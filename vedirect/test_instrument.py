@@ -0,0 +1,60 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import prometheus_client
+
+from . import bench
+from . import instrument
+from . import text
+
+
+def test_instruments(collect):
+    registry = prometheus_client.CollectorRegistry()
+    instruments = instrument.Instruments()
+    registry.register(instruments)
+
+    stream = bench.generate('mppt', 10, corruption=0.3, seed=1)[0]
+    port = instruments.port('ttyUSB0',
+                            text.Parser(validate=True, compact=True))
+    sink = collect
+    timed = instruments.timed(sink, 'sink')
+    for i in range(0, len(stream), 100):
+        for fields in port.feed(stream[i:i + 100]):
+            timed.export(fields)
+    port.feed(b'')
+
+    get = registry.get_sample_value
+    stats = port.parser.stats
+    assert get('victron_read_bytes_total', {'port': 'ttyUSB0'}) == len(stream)
+    assert get('victron_empty_reads_total', {'port': 'ttyUSB0'}) == 1
+    assert get('victron_parsed_blocks_total', {
+        'port': 'ttyUSB0',
+        'result': 'valid'
+    }) == stats.valid == len(sink.blocks)
+    assert get('victron_parsed_blocks_total', {
+        'port': 'ttyUSB0',
+        'result': 'bad_checksum'
+    }) == stats.bad_checksum
+    assert get('victron_export_seconds_count',
+               {'exporter': 'sink'}) == len(sink.blocks)
+    assert get('victron_block_latency_seconds_count',
+               {'exporter': 'sink'}) == len(sink.blocks)
+    assert 'ttyUSB0' in instruments.summary()
+
+
+def test_latency_of_dict_blocks(collect, parse_blocks):
+    timed = instrument.Timed(collect)
+    for fields in parse_blocks(2):
+        timed.export(fields)
+    assert timed.latency.count() == 2
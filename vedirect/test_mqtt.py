@@ -0,0 +1,128 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from unittest import mock
+
+import paho.mqtt.client as paho
+
+from . import mqtt
+
+
+def _published(client):
+    return {c.args[0]: c for c in client.publish.call_args_list}
+
+
+@mock.patch('paho.mqtt.client.Client')
+def test_state_json(client, parse_blocks):
+    e = mqtt.Exporter('localhost', state_json=True, qos=1)
+    e.export(parse_blocks(compact=True)[0])
+
+    published = _published(client.return_value)
+    state = published['tele/victron_HQ1949I8BGA/state']
+    assert json.loads(state.args[1])['v'] == 12.11
+    assert state.kwargs['qos'] == 1
+    config = json.loads(
+        published['homeassistant/sensor/victron_HQ1949I8BGA_v/config'].args[1])
+    assert config['state_topic'] == 'tele/victron_HQ1949I8BGA/state'
+    assert config['value_template'] == '{{ value_json.v }}'
+    assert config['unit_of_measurement'] == 'V'
+    assert 'tele/victron_HQ1949I8BGA/v' not in published
+
+
+@mock.patch('time.monotonic')
+@mock.patch('paho.mqtt.client.Client')
+def test_publish_on_change(client, monotonic, parse_blocks):
+    e = mqtt.Exporter('localhost', heartbeat=300)
+    publish = client.return_value.publish
+    state = dict(parse_blocks(compact=True)[0])
+    monotonic.return_value = 100
+    e.export(state)
+
+    def export(at, **changes):
+        monotonic.return_value = at
+        publish.reset_mock()
+        state.update(changes)
+        e.export(state)
+        return {
+            c.args[0].split('/')[-1]: c.args[1]
+            for c in publish.call_args_list
+        }
+
+    # State changes are published immediately.
+    assert export(101, CS=5) == {'cs': 5}
+    # Small changes are within the deadband.
+    assert export(120, V=12.13) == {}
+    # Large changes wait for the minimum interval.
+    assert export(105, V=13.0) == {}
+    assert export(121, V=13.0) == {'v': 13.0}
+    # A change of exactly one deadband is published.
+    assert export(131, V=12.05) == {'v': 12.05}
+    assert export(141, V=12.1) == {'v': 12.1}
+    # A single step of a 10 Wh counter is published.
+    assert export(220, H20=state['H20'] + 10) == {'h20': state['H20']}
+    # Everything is republished on the heartbeat.
+    assert len(export(520)) == len(state)
+
+
+def _configs(client):
+    return [
+        c.args[0] for c in client.publish.call_args_list
+        if c.args[0].startswith('homeassistant/')
+    ]
+
+
+@mock.patch('paho.mqtt.client.Client')
+def test_discovery_per_device(client, tmp_path, parse_blocks):
+    cache = str(tmp_path / 'discovery.json')
+    client.return_value.publish.return_value.rc = paho.MQTT_ERR_SUCCESS
+    e = mqtt.Exporter('localhost', discovery_cache=cache)
+    first = parse_blocks(compact=True)[0]
+    e.export(first)
+    e.export(dict(first, **{'SER#': 'HQ2'}))
+    e.export(dict(first, **{'SER#': 'HQ2', 'SOC': 1000}))
+    configs = _configs(client.return_value)
+    assert len(configs) == 2 * len(first) + 1
+    assert 'homeassistant/sensor/victron_HQ2_soc/config' in configs
+
+    # Unchanged records are not republished after a restart.
+    client.reset_mock()
+    e = mqtt.Exporter('localhost', discovery_cache=cache)
+    e.export(dict(first, FW='1.54'))
+    assert _configs(client.return_value) == [
+        'homeassistant/sensor/victron_HQ1949I8BGA_pid/config'
+    ]
+
+
+@mock.patch('paho.mqtt.client.Client')
+def test_discovery_before_connect(client, tmp_path, parse_blocks):
+    cache = str(tmp_path / 'discovery.json')
+    publish = client.return_value.publish
+    publish.return_value.rc = paho.MQTT_ERR_NO_CONN
+    e = mqtt.Exporter('localhost', discovery_cache=cache)
+    first = parse_blocks(compact=True)[0]
+    e.export(first)
+    assert len(_configs(client.return_value)) == len(first)
+
+    # The dropped records are republished once connected.
+    client.reset_mock()
+    publish.return_value.rc = paho.MQTT_ERR_SUCCESS
+    client.return_value.on_connect(client.return_value, None, {}, 0)
+    e.export(first)
+    assert len(_configs(client.return_value)) == len(first)
+    client.reset_mock()
+    e.export(first)
+    assert not _configs(client.return_value)
+    with open(cache) as f:
+        assert len(json.load(f)) == len(first)
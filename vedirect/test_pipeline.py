@@ -0,0 +1,85 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from . import pipeline
+
+
+class _Stalled:
+    """An exporter that blocks until released."""
+    def __init__(self):
+        self.release = threading.Event()
+        self.got = []
+
+    def export(self, fields):
+        self.release.wait()
+        self.got.append(fields)
+
+
+def _run(policy, blocks, maxsize=2):
+    e = _Stalled()
+    p = pipeline.Pipeline([e], maxsize, policy)
+    # The first block is picked up by the worker which then stalls.
+    p.export({'SER#': 'first'})
+    while p.depth():
+        pass
+    for b in blocks:
+        p.export(b)
+    e.release.set()
+    p.close()
+    return e.got[1:], p.dropped
+
+
+def test_drop_oldest():
+    got, dropped = _run(pipeline.DROP_OLDEST,
+                        [{'SER#': 'a', 'n': n} for n in range(4)])
+    assert [x['n'] for x in got] == [2, 3]
+    assert dropped == 2
+
+
+def test_latest():
+    got, dropped = _run(pipeline.LATEST, [
+        {'SER#': 'a', 'n': 0},
+        {'SER#': 'b', 'n': 1},
+        {'SER#': 'a', 'n': 2},
+    ])
+    assert got == [{'SER#': 'a', 'n': 2}, {'SER#': 'b', 'n': 1}]
+    assert dropped == 1
+
+
+class _Exclusive:
+    """An exporter that counts calls that overlap another call."""
+    def __init__(self):
+        self.busy = False
+        self.overlaps = 0
+        self.count = 0
+
+    def export(self, fields):
+        if self.busy:
+            self.overlaps += 1
+        self.busy = True
+        time.sleep(0.001)
+        self.count += 1
+        self.busy = False
+
+
+def test_workers_do_not_share_an_exporter():
+    e = _Exclusive()
+    p = pipeline.Pipeline([e], 100, pipeline.BLOCK, workers=4)
+    for n in range(50):
+        p.export({'SER#': 'a', 'n': n})
+    p.close()
+    assert (e.count, e.overlaps) == (50, 0)
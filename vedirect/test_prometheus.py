@@ -0,0 +1,106 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+
+import prometheus_client
+
+from . import block
+from . import filters
+from . import prometheus
+from . import test_text
+from . import text
+
+
+def test_collector(parse_blocks):
+    registry = prometheus_client.CollectorRegistry()
+    c = prometheus.Collector(filters.FilterBank(tau=1 / math.log(2)))
+    registry.register(c)
+    blocks = parse_blocks(3, compact=True)
+    for i, fields in enumerate(blocks):
+        fields.time = 1000.0 + i
+        c.export(fields)
+
+    labels = {'serial_number': 'HQ1949I8BGA', 'product_id': '0xA042'}
+    get = registry.get_sample_value
+    assert get('victron_v_volt', labels) == 12.11
+    assert get('victron_h19_wh', labels) == 430
+    assert get('victron_cs', dict(labels, victron_cs='bulk')) == 1
+    assert get('victron_cs', dict(labels, victron_cs='off')) == 0
+    assert get('victron_cs_value', labels) == 3
+    assert get('victron_fw_info', dict(labels, fw='1.53')) == 1
+    assert get('victron_blocks_total', labels) == 3
+    # Gauges are filtered with the blocks seen by each scrape.
+    c.export(block.Block(dict(blocks[0].items(), V=14.11), 1004.0))
+    assert get('victron_v_volt', labels) == 13.61
+    # Scraping the same block again does not step the filters.
+    assert get('victron_v_volt', labels) == 13.61
+
+
+def test_exporter_creates_seen_fields(parse_blocks):
+    registry = prometheus_client.CollectorRegistry()
+    e = prometheus.Exporter(registry)
+    fields = parse_blocks()[0]
+    del fields['VPV']
+    # A BMV field that has not been tested and one that is not known.
+    fields['SOC'] = 876
+    fields['XYZ'] = 'abc'
+    e.export(fields)
+
+    labels = {'serial_number': 'HQ1949I8BGA', 'product_id': '0xA042'}
+    get = registry.get_sample_value
+    assert get('victron_v_volt', labels) == 12.11
+    assert get('victron_vpv_volt', labels) is None
+    assert get('victron_soc', labels) == 876
+    assert get('victron_xyz_info', dict(labels, xyz='abc')) == 1
+
+
+def test_exporter_filters_by_arrival(parse_blocks):
+    registry = prometheus_client.CollectorRegistry()
+    e = prometheus.Exporter(registry,
+                            bank=filters.FilterBank(tau=1 / math.log(2)))
+    first, second = parse_blocks(2, compact=True)
+    first.time = 1000.0
+    second = block.Block(dict(second.items(), V=14.11), 1001.0)
+    # Blocks that were queued are exported in a burst.
+    e.export(first)
+    e.export(second)
+
+    labels = {'serial_number': 'HQ1949I8BGA', 'product_id': '0xA042'}
+    # The blocks arrived a half-life apart.
+    assert registry.get_sample_value('victron_v_volt', labels) == 13.11
+    assert registry.get_sample_value('victron_updated', labels) == 1001.0
+
+
+def test_unknown_enum_code(caplog):
+    data = (test_text._SYNC + test_text._BLOCK * 2).replace(
+        b'\n', b'\r\n').replace(b'CS\t3', b'CS\t99')
+    labels = {'serial_number': 'HQ1949I8BGA', 'product_id': '0xA042'}
+
+    registry = prometheus_client.CollectorRegistry()
+    e = prometheus.Exporter(registry)
+    for fields in text.Parser().feed(data):
+        e.export(fields)
+    assert registry.get_sample_value('victron_cs_value', labels) == 99
+
+    registry = prometheus_client.CollectorRegistry()
+    c = prometheus.Collector()
+    registry.register(c)
+    c.export(text.Parser(compact=True).feed(data)[-1])
+    assert registry.get_sample_value('victron_cs_value', labels) == 99
+    assert registry.get_sample_value('victron_cs_value', labels) == 99
+
+    # Each code is logged once.
+    assert [r.getMessage()
+            for r in caplog.records] == ['unknown CS code 99']
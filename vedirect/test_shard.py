@@ -0,0 +1,56 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import socketserver
+import threading
+
+from . import block
+from . import shard
+from . import test_text
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data = (test_text._SYNC + test_text._BLOCK * 3).replace(
+            b'\n', b'\r\n')
+        self.request.sendall(data)
+        # Hold the connection until the client goes away.
+        self.request.recv(1)
+
+
+def test_shards(collect):
+    servers = []
+    for _ in range(2):
+        s = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _Handler)
+        s.daemon_threads = True
+        threading.Thread(target=s.serve_forever, daemon=True).start()
+        servers.append(s)
+    ports = ['tcp://127.0.0.1:%d' % s.server_address[1] for s in servers]
+
+    shards = shard.Shards(ports, workers=2)
+    out = collect
+    shards.start()
+    try:
+        for _ in range(30):
+            shards.pump([out])
+            if len(out.blocks) >= 6:
+                break
+    finally:
+        shards.close()
+        for s in servers:
+            s.shutdown()
+
+    assert len(out.blocks) == 6
+    assert all(isinstance(x, block.Block) for x in out.blocks)
+    assert out.blocks[0]['SER#'] == 'HQ1949I8BGA'
+    assert shards.restarts == 0
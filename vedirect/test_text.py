@@ -13,13 +13,16 @@
 # limitations under the License.
 
 import io
+import os
+import subprocess
+import sys
 
-import pint
-
+from . import block
 from . import defs
 from . import text
+from . import units
 
-_ureg = pint.UnitRegistry()
+_ureg = units.registry()
 
 _SYNC = b"""
 Checksum	&
@@ -73,3 +76,103 @@ def test_parse():
     }
     got = next(parser)
     assert got == want
+    assert got.time > 0
+
+
+def test_parse_split_reads():
+    block = (_SYNC + _BLOCK + _BLOCK).replace(b'\n', b'\r\n')
+    parser = text.Parser()
+    got = []
+    for i in range(0, len(block), 7):
+        got.extend(parser.feed(block[i:i + 7]))
+    assert len(got) == 2
+    assert got[0] == got[1]
+    assert got[0]['SER#'] == 'HQ1949I8BGA'
+    assert got[0]['HSDS'] == 7 * _ureg.day
+
+
+def test_parse_validate():
+    good = _BLOCK.replace(b'\n', b'\r\n')
+    bad_sum = good.replace(b'V\t12110', b'V\t12111')
+    bad_framing = good.replace(b'VPV\t13590\r\n', b'VPV\t13590\r')
+    stream = (_SYNC.replace(b'\n', b'\r\n') + good + bad_sum + good +
+              bad_framing + good + good)
+    parser = text.Parser(validate=True)
+    got = parser.feed(stream)
+    assert len(got) == 4
+    assert all(x['V'] == 12.110 * _ureg.volt for x in got)
+    assert parser.stats.valid == 4
+    assert parser.stats.bad_checksum == 1
+    assert parser.stats.framing_errors == 1
+
+
+def test_parse_invalid_utf8():
+    good = _BLOCK.replace(b'\n', b'\r\n')
+    corrupt = good.replace(b'SER#\tHQ1949I8BGA', b'SER#\tHQ\xff949I8BGA')
+    stream = _SYNC.replace(b'\n', b'\r\n') + corrupt + good
+    # The checksum catches corrupt values when validating.
+    parser = text.Parser(validate=True)
+    assert len(parser.feed(stream)) == 1
+    assert parser.stats.bad_checksum == 1
+    # Otherwise they are decoded with a replacement character.
+    got = text.Parser(compact=True).feed(stream)
+    assert got[0]['SER#'] == 'HQ\ufffd949I8BGA'
+
+
+def test_parse_framing_error():
+    good = _BLOCK.replace(b'\n', b'\r\n')
+    bad = good.replace(b'VPV\t13590\r\n', b'VPV\t13590\r')
+    parser = text.Parser()
+    try:
+        parser.feed(_SYNC.replace(b'\n', b'\r\n') + good + bad + good)
+        assert False, 'want a ProtocolError'
+    except text.ProtocolError as ex:
+        # The block before the error is kept.
+        assert len(ex.blocks) == 1
+    # The parser resyncs at the bad block's checksum and resumes with
+    # the rest of the buffer.
+    assert len(parser.feed(good + good)) == 3
+
+
+def test_parse_compact():
+    data = (_SYNC + _BLOCK).replace(b'\n', b'\r\n')
+    full = next(text.parse(io.BytesIO(data)))
+    got = next(text.parse(io.BytesIO(data), compact=True))
+    assert got['V'] == 12.110
+    assert got['CS'] == 3
+    assert got['LOAD'] == 1
+    assert got['FW'] == '1.53'
+    assert got.unit('H19') == 'hour * watt'
+    assert got.to_dict() == full
+    assert dict(block.plain(got)) == dict(block.plain(full))
+
+
+def test_parse_fill():
+    data = (_SYNC + _BLOCK + _BLOCK).replace(b'\n', b'\r\n')
+    src = io.BytesIO(data)
+    parser = text.Parser()
+
+    def readinto(view):
+        return src.readinto(view[:7])
+
+    got = []
+    while True:
+        n, blocks = parser.fill(readinto)
+        if not n:
+            break
+        got.extend(blocks)
+    assert got == text.Parser().feed(data)
+    assert len(got) == 2
+
+
+def test_compact_without_pint():
+    # Compact decoding must not build or even import pint.
+    code = """
+import sys
+from vedirect import text
+data = %r
+assert text.Parser(compact=True).feed(data)[0]['V'] == 12.110
+assert 'pint' not in sys.modules
+""" % (_SYNC + _BLOCK).replace(b'\n', b'\r\n')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.check_call([sys.executable, '-c', code], cwd=root)
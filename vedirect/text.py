@@ -13,11 +13,10 @@
 # limitations under the License.
 """Implements a VE.Direct text protocol decoder."""
 
-import enum
-from typing import Iterator, Tuple
-
-import pint
+import time
+from typing import Callable, Iterator, List, Optional, Tuple, Union
 
+from . import block
 from . import defs
 
 _LF = 0x0A
@@ -25,101 +24,281 @@ _CR = 0x0D
 _TAB = 0x09
 _CHECKSUM = 'Checksum'
 
-# Parsers for certain unique field values.
-_PARSERS = {
-    defs.FW.label: lambda x: '%d.%d' % (int(x) // 100, int(x) % 100),
-    defs.LOAD.label: lambda x: 1 if x == 'ON' else 0,
-}
+# Number of bytes to request from the source on each read.
+_READ_SIZE = 1000
+# Longest label or value accepted before the line is treated as noise.
+_MAX_LINE = 128
+# Initial size of the parser buffer.
+_BUFFER_SIZE = 4096
 
+_Line = Tuple[str, bytes, int, int]
 
-class ProtocolError(RuntimeError):
-    pass
+_DECODERS = defs.DECODERS
 
+Fields = Union[dict, block.Block]
 
-class _Source:
-    """A simple buffered reader."""
-    def __init__(self, f):
-        self._f = f
-        self._ready = b''
 
-    def next(self) -> int:
-        while self._ready is None or len(self._ready) == 0:
-            self._ready = self._f.read(1000)
+class ProtocolError(RuntimeError):
+    """Raised on a framing error when not validating.
 
-        ch, self._ready = self._ready[0], self._ready[1:]
-        return ch
+    blocks holds the blocks completed before the error. The parser has
+    resynced, so feeding it more data resumes at the next block.
+    """
+    def __init__(self, message: str, blocks: Optional[list] = None):
+        super().__init__(message)
+        self.blocks = blocks or []
 
 
-def _get_value(label: str, value: bytearray) -> object:
+def _get_value(label: str, value: bytes, decoders=_DECODERS) -> object:
     """Parses the value in a label specific way."""
     if label == _CHECKSUM:
         return value[0]
 
-    value = value.decode()
+    # Corrupt values are caught by the checksum when validating.
+    value = value.decode(errors='replace')
     try:
-        if label not in defs.FIELD_MAP:
-            return int(value)
-        field = defs.FIELD_MAP[label]
-        kind = field.kind()
-        if field.label in _PARSERS:
-            value = _PARSERS[field.label](value)
-        if kind is not None:
-            if isinstance(kind, pint.Quantity):
-                return int(value) * kind
-            elif issubclass(kind, enum.Enum):
-                return kind(int(value))
-            elif issubclass(kind, str):
-                return value
-            assert False, 'Unhandled kind %s' % kind
-        return int(value)
+        return decoders.get(label, int)(value)
     except ValueError:
         return value
 
 
-def _get_line(src: _Source) -> Tuple[str, object]:
-    label = bytearray()
+class Stats:
+    """Counts the outcome of each block seen by a validating parser."""
+    __slots__ = ('valid', 'bad_checksum', 'framing_errors')
 
-    while True:
-        ch = src.next()
-        if ch == _TAB:
-            break
-        label.append(ch)
+    def __init__(self):
+        self.valid = 0
+        self.bad_checksum = 0
+        self.framing_errors = 0
 
-    value = bytearray((src.next(), ))
+    def __repr__(self) -> str:
+        return 'Stats(valid=%d, bad_checksum=%d, framing_errors=%d)' % (
+            self.valid, self.bad_checksum, self.framing_errors)
 
-    while True:
-        ch = src.next()
-        if ch == _CR:
-            break
-        value += bytes([ch])
 
-    ch = src.next()
-    if ch != _LF:
-        raise ProtocolError('got a 0x%x, want a LF' % ch)
+class _Lines:
+    """Splits a byte stream into label and value pairs.
 
-    label = label.decode()
-    return label, _get_value(label, value)
+    Input is kept in a single preallocated buffer between _pos and _end
+    and the TAB and CR boundaries are found with bulk searches. Sources
+    may read straight into the buffer with fill(). Partial lines are
+    kept until the next feed.
+    """
+    def __init__(self, checksum: bool = False):
+        self._buf = bytearray(_BUFFER_SIZE)
+        self._pos = 0
+        self._end = 0
+        self._checksum = checksum
 
+    def _reserve(self, size: int) -> None:
+        """Makes room for at least size more bytes after _end."""
+        buf = self._buf
+        if self._pos:
+            # Move any partial line to the start.
+            pending = self._end - self._pos
+            buf[:pending] = buf[self._pos:self._end]
+            self._pos = 0
+            self._end = pending
+        if len(buf) - self._end < size:
+            buf.extend(bytes(size - (len(buf) - self._end)))
 
-def parse(src) -> Iterator[dict]:
-    src = _Source(src)
+    def feed(self, data) -> None:
+        size = len(data)
+        self._reserve(size)
+        self._buf[self._end:self._end + size] = data
+        self._end += size
 
-    while src.next() != _LF:
-        pass
+    def fill(self, readinto: Callable[[memoryview], int]) -> int:
+        """Reads directly into the buffer and returns the number of bytes
+        read."""
+        self._reserve(_READ_SIZE)
+        with memoryview(self._buf) as view:
+            got = readinto(view[self._end:])
+        self._end += got
+        return got
 
-    while True:
-        label, value = _get_line(src)
-        if label == _CHECKSUM:
-            break
+    def clear(self) -> None:
+        """Drops all buffered input."""
+        self._pos = self._end = 0
+
+    def sync(self) -> bool:
+        """Skips to just after the next LF. Returns False if none is found."""
+        lf = self._buf.find(b'\n', self._pos, self._end)
+        if lf < 0:
+            self._pos = self._end
+            return False
+        self._pos = lf + 1
+        return True
+
+    def split(self) -> Tuple[List[_Line], Optional[str]]:
+        """Returns all complete lines in the buffer and any framing error.
+
+        Each line is a (label, value, head, tail) tuple. When checksums
+        are enabled, head is the byte sum of the label, TAB, and first
+        value byte and tail is the sum of the rest of the line.
+        """
+        buf = self._buf
+        end = self._end
+        pos = self._pos
+        checksum = self._checksum
+        lines = []
+        error = None
+
+        while True:
+            tab = buf.find(b'\t', pos, min(pos + _MAX_LINE, end))
+            if tab < 0:
+                if end - pos >= _MAX_LINE:
+                    error = 'no TAB in %d bytes' % _MAX_LINE
+                    pos = end
+                break
+            # The value is at least one byte long as the checksum may
+            # be any value, including a CR.
+            cr = buf.find(b'\r', tab + 2, min(tab + _MAX_LINE, end))
+            if cr < 0:
+                if end - tab >= _MAX_LINE:
+                    error = 'no CR in %d bytes' % _MAX_LINE
+                    pos = end
+                break
+            if cr + 1 >= end:
+                break
+            if buf[cr + 1] != _LF:
+                error = 'got a 0x%x, want a LF' % buf[cr + 1]
+                pos = cr + 1
+                break
+            if checksum:
+                head = sum(buf[pos:tab + 2])
+                tail = sum(buf[tab + 2:cr + 2])
+            else:
+                head = tail = 0
+            lines.append(
+                (buf[pos:tab].decode(errors='replace'),
+                 bytes(buf[tab + 1:cr]), head, tail))
+            pos = cr + 2
+
+        self._pos = pos
+        return lines, error
 
-    while True:
-        fields = {}
+
+class Parser:
+    """Incrementally decodes a byte stream into blocks of fields.
+
+    When validate is set, the block checksum is checked, blocks with a
+    bad checksum or framing are dropped, and the parser resyncs at the
+    next block boundary instead of raising ProtocolError. The outcome
+    of each block is counted in stats.
+
+    Blocks are returned as block.Quantities, or as block.Block when
+    compact is set, with the time the first byte of the block was fed.
+    """
+    def __init__(self, validate: bool = False, compact: bool = False):
+        self.stats = Stats()
+        self._validate = validate
+        self._compact = compact
+        self._decoders = defs.RAW_DECODERS if compact else _DECODERS
+        self._lines = _Lines(checksum=validate)
+        self._synced = False
+        self._seen_lf = False
+        # Blocks are collected in a plain dict if compact.
+        self._new = dict if compact else block.Quantities
+        self._fields = self._new()  # type: dict
+        # Running byte sum of the current block.
+        self._sum = 0
+        # Time the current block started.
+        self._started = 0.0
+
+    def _resync(self) -> None:
+        self._synced = False
+        self._seen_lf = False
+        self._fields = self._new()
+
+    def reset(self) -> None:
+        """Drops any buffered input and partial block.
+
+        Call this when the source reconnects as the stream is then
+        discontinuous. Decoding resumes at the next block.
+        """
+        self._lines.clear()
+        self._resync()
+
+    def feed(self, data, now: Optional[float] = None) -> List[Fields]:
+        """Adds data to the stream and returns any completed blocks.
+
+        now is the time the data arrived, defaulting to time.time().
+        """
+        self._lines.feed(data)
+        return self._decode(now)
+
+    def fill(self,
+             readinto: Callable[[memoryview], int],
+             now: Optional[float] = None) -> Tuple[int, List[Fields]]:
+        """Reads from a source straight into the parser buffer.
+
+        readinto is called with a writable view and returns the number
+        of bytes written, like io.RawIOBase.readinto(). Returns the
+        number of bytes read and any completed blocks.
+        """
+        got = self._lines.fill(readinto)
+        if not got:
+            return 0, []
+        return got, self._decode(now)
+
+    def _decode(self, now: Optional[float]) -> List[Fields]:
+        if now is None:
+            now = time.time()
+        lines = self._lines
+        blocks = []  # type: List[Fields]
 
         while True:
-            label, value = _get_line(src)
+            if not self._seen_lf:
+                if not lines.sync():
+                    return blocks
+                self._seen_lf = True
+
+            got, error = lines.split()
+            self._consume(got, blocks, now)
+            if error is None:
+                return blocks
+            if self._synced:
+                if not self._validate:
+                    self._resync()
+                    raise ProtocolError(error, blocks)
+                self.stats.framing_errors += 1
+            self._resync()
+
+    def _consume(self, lines: List[_Line], blocks: List[Fields],
+                 now: float) -> None:
+        fields = self._fields
+        decoders = self._decoders
+        for label, value, head, tail in lines:
             if label == _CHECKSUM:
                 # End of a block
-                break
-            fields[label] = value
+                if not self._synced:
+                    self._synced = True
+                elif not self._validate or (self._sum + head) & 0xFF == 0:
+                    if self._validate:
+                        self.stats.valid += 1
+                    if self._compact:
+                        fields = block.Block(fields, self._started)
+                    else:
+                        fields.time = self._started
+                    blocks.append(fields)
+                else:
+                    self.stats.bad_checksum += 1
+                fields = self._fields = self._new()
+                # The rest of the line starts the next block.
+                self._sum = tail
+                self._started = now
+            elif self._synced:
+                fields[label] = _get_value(label, value, decoders)
+                self._sum += head + tail
+
 
-        yield fields
+def parse(src,
+          validate: bool = False,
+          compact: bool = False) -> Iterator[Fields]:
+    parser = Parser(validate, compact)
+
+    while True:
+        data = src.read(_READ_SIZE)
+        if data:
+            yield from parser.feed(data)
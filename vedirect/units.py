@@ -0,0 +1,51 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""The shared pint unit registry, built on first use.
+
+Building a registry parses pint's definitions, which takes a good part
+of a second on small boards, so it is only built once something asks
+for a quantity. Decoding with compact blocks never does.
+"""
+
+import sys
+from typing import Dict
+
+_registry = None
+_units = {}  # type: Dict[str, object]
+
+
+def registry():
+    """Returns the shared pint.UnitRegistry."""
+    global _registry  # pylint: disable=global-statement
+    if _registry is None:
+        import pint  # pylint: disable=import-outside-toplevel
+        _registry = pint.UnitRegistry()
+    return _registry
+
+
+def unit(name: str):
+    """Returns the pint.Unit for a name such as 'volt' or 'hour * watt'."""
+    u = _units.get(name)
+    if u is None:
+        u = _units[name] = registry().Unit(name)
+    return u
+
+
+def magnitude(value: object) -> object:
+    """Returns the magnitude of a pint quantity or value unchanged."""
+    pint = sys.modules.get('pint')
+    if pint is None:
+        # No quantity can exist until pint is imported.
+        return value
+    return value.m if isinstance(value, pint.Quantity) else value